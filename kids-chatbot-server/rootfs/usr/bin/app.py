@@ -1,44 +1,105 @@
 #!/usr/bin/env python3
 import os
+import sys
+import atexit
 import logging
-import tempfile
+import logging.handlers
+import queue
 import time
 import secrets
+import threading
+import heapq
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
 from datetime import datetime, timedelta
-from flask import Flask, request, make_response, jsonify, send_from_directory, Response
+from flask import Flask, request, make_response, jsonify, send_from_directory, Response, stream_with_context
 from flask_cors import CORS
 from openai import OpenAI
+import httpx
 from pathlib import Path
 import io
+import base64
 import struct
+import shutil
 import json
+import re
+import math
+from array import array
 
 # Import utilities
-from utils.content_filter import is_safe_content
+from utils.content_filter import detect_language, classify
 from utils.response_templates import get_response_template
+from utils.json_provider import OrjsonProvider, orjson
+from utils.ttl_cache import TTLCache
+try:
+    import numpy as np
+except ImportError:
+    np = None
+try:
+    from scipy.signal import firwin, lfilter
+except ImportError:
+    firwin = lfilter = None
 try:
     from utils.db_helper import DatabaseHelper
     db = DatabaseHelper
 except ImportError:
-    logger.warning("⚠️ Database helper not available, using in-memory only")
+    # mysql-connector chưa cài: chỉ dùng bộ nhớ (cảnh báo sau khi đã có logger)
     db = None
+try:
+    from utils.redis_helper import RedisSessionStore
+except ImportError:
+    RedisSessionStore = None
+try:
+    from flask_compress import Compress
+except ImportError:
+    Compress = None
     
 SERVER_URL = os.getenv('SERVER_URL', 'https://school.sfdp.net')
+# Base URL của file debug audio, ghép một lần lúc khởi động
+DEBUG_AUDIO_URL_BASE = f"{SERVER_URL.rstrip('/')}/debug/audio/"
+# Nếu chạy sau nginx: prefix location "internal" alias tới debug_audio/ (vd: /internal-audio/)
+AUDIO_ACCEL_REDIRECT_PREFIX = os.getenv('AUDIO_ACCEL_REDIRECT_PREFIX', '')
+# Nếu chạy sau Apache (mod_xsendfile) / lighttpd: /debug/audio/<filename> chỉ trả header X-Sendfile
+USE_X_SENDFILE = os.getenv('USE_X_SENDFILE', 'false').lower() == 'true'
 
 # Set up logging
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
 if LOG_LEVEL not in ["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]:
     LOG_LEVEL = "INFO"
 
-logging.basicConfig(
-    level=getattr(logging, LOG_LEVEL),
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+# Request thread chỉ đẩy log vào queue; ghi stderr ở thread riêng (QueueListener)
+log_queue = queue.SimpleQueue()
+log_stream_handler = logging.StreamHandler()
+log_stream_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+log_listener = logging.handlers.QueueListener(log_queue, log_stream_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+log_queue_handler = logging.handlers.QueueHandler(log_queue)
+log_queue_handler.setFormatter(logging.Formatter('%(message)s'))
+
+logging.basicConfig(level=getattr(logging, LOG_LEVEL), handlers=[log_queue_handler])
 logger = logging.getLogger(__name__)
 
 # Initialize Flask app
 app = Flask(__name__, static_folder='/usr/bin/static')
 CORS(app)
+if orjson:
+    app.json = OrjsonProvider(app)
+else:
+    logger.warning("⚠️ orjson not available, using stdlib json")
+
+# Nén gzip/deflate cho JSON/HTML lớn (context stats, debug list); audio và SSE không nén, không bị buffer
+if Compress:
+    app.config.update(
+        COMPRESS_MIMETYPES=['application/json', 'text/html'],
+        COMPRESS_ALGORITHM=['gzip', 'deflate'],
+        COMPRESS_LEVEL=6,
+        COMPRESS_MIN_SIZE=1024,
+        COMPRESS_STREAMS=False
+    )
+    Compress(app)
 
 # --- Configuration ---
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
@@ -48,11 +109,47 @@ PORT = int(os.getenv("PORT", "5000"))
 MAX_TOKENS = int(os.getenv("MAX_TOKENS", "500"))
 TEMPERATURE = float(os.getenv("TEMPERATURE", "0.7"))
 
+# TTS song song theo câu khi stream chat trong /api/voice-chat
+TTS_WORKERS = int(os.getenv("TTS_WORKERS", "4"))
+TTS_MIN_SENTENCE_CHARS = int(os.getenv("TTS_MIN_SENTENCE_CHARS", "40"))
+# Tạo sẵn audio cho các câu cố định (greeting, xác nhận lệnh) khi khởi động
+TTS_WARMUP = os.getenv("TTS_WARMUP", "true").lower() == "true"
+
+# Streaming: số delta gộp lại trước khi gửi, tăng dần từ MIN đến MAX
+STREAM_MIN_BATCH = int(os.getenv("STREAM_MIN_BATCH", "1"))
+STREAM_MAX_BATCH = int(os.getenv("STREAM_MAX_BATCH", "16"))
+
+# /api/chat/batch tạo job OpenAI Batch (tốn tiền) và không có xác thực → mặc định tắt
+BATCH_API_ENABLED = os.getenv("BATCH_API_ENABLED", "false").lower() == "true"
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "100"))
+
+# Audio có RMS (PCM 16-bit) dưới ngưỡng coi như im lặng → không gọi Whisper (0 = tắt)
+SILENCE_RMS_THRESHOLD = float(os.getenv("SILENCE_RMS_THRESHOLD", "100"))
+
+# Cache Chat+TTS theo câu đã transcribe (0 = tắt)
+# Chỉ có tác dụng khi CONTEXT_ENABLED=false: có context thì lượt đầu là greeting, các lượt sau phụ thuộc lịch sử
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "256"))
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+TTS_CACHE_SIZE = int(os.getenv("TTS_CACHE_SIZE", "256"))
+# Cache câu trả lời (text) theo (ngôn ngữ, câu hỏi chuẩn hoá) cho cả /api/chat (0 = tắt)
+REPLY_CACHE_SIZE = int(os.getenv("REPLY_CACHE_SIZE", "2048"))
+
 CONTEXT_ENABLED = os.getenv("CONTEXT_ENABLED", "true").lower() == "true"
 CONTEXT_MAX_MESSAGES = int(os.getenv("CONTEXT_MAX_MESSAGES", "20"))
+# Giới hạn token ước lượng của lịch sử (không tính system prompt), 0 = chỉ giới hạn theo số tin nhắn
+CONTEXT_MAX_TOKENS = int(os.getenv("CONTEXT_MAX_TOKENS", "0"))
 CONTEXT_TIMEOUT_MINUTES = int(os.getenv("CONTEXT_TIMEOUT_MINUTES", "30"))
+# Lịch sử đầy: tóm tắt các lượt cũ thành một tin nhắn thay vì bỏ hẳn (giữ nguyên COMPACTION_KEEP_RECENT tin gần nhất)
+COMPACTION_ENABLED = os.getenv("COMPACTION_ENABLED", "false").lower() == "true"
+COMPACTION_KEEP_RECENT = int(os.getenv("COMPACTION_KEEP_RECENT", "6"))
+# Tóm tắt lỗi (OpenAI sự cố / hết quota) → tạm dừng tóm tắt trong N giây, chỉ cắt lịch sử như cũ
+COMPACTION_RETRY_SECONDS = int(os.getenv("COMPACTION_RETRY_SECONDS", "300"))
+# Số session tối đa giữ trong bộ nhớ; vượt quá thì bỏ session lâu không hoạt động nhất
+MAX_SESSIONS = max(1, int(os.getenv("MAX_SESSIONS", "10000")))
 CONTEXT_PERSIST = os.getenv("CONTEXT_PERSIST", "true").lower() == "true"  # ⬅️ THÊM MỚI
 CONTEXT_STORAGE_DIR = os.getenv("CONTEXT_STORAGE_DIR", "/data/conversations")  # ⬅️ THÊM MỚI
+# Redis session store (vd: redis://localhost:6379/0), để trống = không dùng
+REDIS_URL = os.getenv("REDIS_URL", "")
 
 BOT_LANGUAGE = os.getenv("BOT_LANGUAGE", "vi").lower()
 CUSTOM_PROMPT_ADDITIONS = os.getenv("CUSTOM_PROMPT_ADDITIONS", "")
@@ -64,6 +161,84 @@ VOICE_MAP = {
     'auto': OPENAI_VOICE
 }
 
+# Templates tính sẵn một lần khi khởi động (chỉ phụ thuộc ngôn ngữ + config)
+TEMPLATE_LANGUAGES = ('vi', 'en', 'auto')
+SYSTEM_PROMPTS = {
+    lang: get_response_template('system', lang).replace("{{CUSTOM_INSTRUCTIONS}}", CUSTOM_PROMPT_ADDITIONS)
+    for lang in TEMPLATE_LANGUAGES
+}
+GREETINGS = {lang: get_response_template('greeting', lang) for lang in TEMPLATE_LANGUAGES}
+INAPPROPRIATE_RESPONSES = {lang: get_response_template('inappropriate', lang) for lang in TEMPLATE_LANGUAGES}
+
+# Câu xác nhận đọc cho ESP32 khi AI trả về lệnh điều khiển thiết bị
+COMMAND_CONFIRMATIONS = {
+    'set_volume': {
+        'vi': 'Đã điều chỉnh âm lượng',
+        'en': 'Volume adjusted'
+    },
+    'set_mic_gain': {
+        'vi': 'Đã chỉnh độ nhạy mic',
+        'en': 'Mic sensitivity adjusted'
+    },
+    'stop_conversation': {
+        'vi': 'Tạm biệt',
+        'en': 'Goodbye'
+    }
+}
+
+# Các câu cố định: TTS chỉ tạo một lần cho mỗi voice rồi giữ trong bộ nhớ
+CANNED_TTS_TEXTS = frozenset((
+    *GREETINGS.values(),
+    *INAPPROPRIATE_RESPONSES.values(),
+    *(text for texts in COMMAND_CONFIRMATIONS.values() for text in texts.values())
+))
+
+
+def encode_header_text(text):
+    """Đưa text UTF-8 vào HTTP header (header chỉ nhận latin-1)"""
+    if text.isascii():
+        # ASCII giống hệt nhau ở UTF-8 và latin-1: dùng lại chuỗi, không encode/decode
+        return text
+    return text.encode('utf-8').decode('latin-1')
+
+
+def encode_header_text_b64(text):
+    """Đưa text UTF-8 vào HTTP header dạng base64 (ASCII hợp lệ, client giải mã không cần đoán charset)"""
+    return base64.b64encode(text.encode('utf-8')).decode('ascii')
+
+
+# Header đã encode sẵn cho các câu trả lời cố định
+HEADER_TEXTS = {
+    text: encode_header_text(text)
+    for text in (*GREETINGS.values(), *INAPPROPRIATE_RESPONSES.values())
+}
+
+
+def get_system_prompt(language):
+    """System prompt theo ngôn ngữ, đã chèn CUSTOM_PROMPT_ADDITIONS"""
+    return SYSTEM_PROMPTS.get(language, SYSTEM_PROMPTS['vi'])
+
+
+# Message system dựng sẵn, dùng chung cho mọi session (không được sửa)
+SYSTEM_MESSAGES = {lang: {"role": "system", "content": prompt} for lang, prompt in SYSTEM_PROMPTS.items()}
+
+
+def get_system_message(language):
+    """Message {"role": "system"} theo ngôn ngữ, dùng chung giữa các request"""
+    return SYSTEM_MESSAGES.get(language, SYSTEM_MESSAGES['vi'])
+
+
+# System prompt là prefix cố định của mọi request chat → gắn prompt_cache_key theo ngôn ngữ
+# để các session cùng ngôn ngữ được route tới cùng prompt cache phía OpenAI
+PROMPT_CACHE_KEYS = {prompt: f"kids-chatbot-{lang}" for lang, prompt in SYSTEM_PROMPTS.items()}
+
+
+def prompt_cache_body(messages):
+    """extra_body cho chat.completions: prompt_cache_key theo system prompt (None nếu không khớp)"""
+    key = PROMPT_CACHE_KEYS.get(messages[0]['content'])
+    return {'prompt_cache_key': key} if key else None
+
+
 logger.info(f"--- Yên Hoà ChatBot Server Starting ---")
 logger.info(f"Model: {OPENAI_MODEL}")
 logger.info(f"Voice: {OPENAI_VOICE}")
@@ -81,10 +256,24 @@ if not OPENAI_API_KEY:
     client = None
 else:
     logger.info("OpenAI API key is configured")
-    client = OpenAI(api_key=OPENAI_API_KEY)
+    # Một connection pool giữ TLS session tới api.openai.com cho Whisper + Chat + TTS
+    try:
+        import h2  # noqa: F401 - httpx cần h2 để bật HTTP/2
+        http2_enabled = True
+    except ImportError:
+        http2_enabled = False
+    http_client = httpx.Client(
+        http2=http2_enabled,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50, keepalive_expiry=300.0),
+        timeout=httpx.Timeout(60.0, connect=5.0)
+    )
+    client = OpenAI(api_key=OPENAI_API_KEY, http_client=http_client)
+    logger.info(f"OpenAI HTTP client: pooled, HTTP/2 {'enabled' if http2_enabled else 'unavailable (install h2)'}")
 
 # Initialize database connection
-if CONTEXT_PERSIST and db:
+if CONTEXT_PERSIST and db is None:
+    logger.warning("⚠️ Database helper not available, using in-memory only")
+elif CONTEXT_PERSIST:
     DB_CONFIG = {
         'host': os.getenv('DB_HOST', '192.168.100.35'),
         'user': os.getenv('DB_USER', 'paulsteigel'),
@@ -107,8 +296,114 @@ if CONTEXT_PERSIST:
     Path(CONTEXT_STORAGE_DIR).mkdir(parents=True, exist_ok=True)
     logger.info(f"📁 Context storage: {CONTEXT_STORAGE_DIR}")
 
-# In-memory conversation storage
-conversations = {}
+# Initialize Redis session store
+redis_store = None
+if REDIS_URL:
+    if RedisSessionStore is None:
+        logger.warning("⚠️ REDIS_URL is set but redis package is not installed")
+    else:
+        try:
+            RedisSessionStore.initialize(REDIS_URL, CONTEXT_TIMEOUT_MINUTES * 60, CONTEXT_MAX_MESSAGES)
+            redis_store = RedisSessionStore
+            logger.info("✅ Redis session store enabled")
+        except Exception as e:
+            logger.error(f"❌ Redis initialization failed: {e}")
+
+# Nơi lưu session ngoài bộ nhớ: Redis (đọc nhanh, TTL tự hết hạn) rồi MySQL (lưu lâu dài)
+session_stores = [store for store in (redis_store, db if CONTEXT_PERSIST else None) if store]
+
+# In-memory conversation storage (thứ tự LRU: session hoạt động gần nhất ở cuối)
+conversations = OrderedDict()
+
+# Lock theo session (RLock vì add_message gọi lại get_or_create_session):
+# các thread xử lý cùng một session không chen nhau khi đọc/ghi lịch sử.
+# Dùng một dãy lock cố định chia theo hash(session_id): không phải tạo/xoá lock theo session,
+# nên session bị xoá rồi tạo lại vẫn dùng đúng lock cũ
+SESSION_LOCK_STRIPES = 64
+session_locks = tuple(threading.RLock() for _ in range(SESSION_LOCK_STRIPES))
+
+
+def session_lock(session_id):
+    """Lock của session (các session khác nhau phần lớn dùng lock khác nhau → vẫn chạy song song)"""
+    return session_locks[hash(session_id) % SESSION_LOCK_STRIPES]
+
+# Min-heap (hạn hết hạn, session_id): mỗi lần session hoạt động đẩy thêm một entry,
+# janitor chỉ xử lý các entry đã tới hạn và bỏ qua entry cũ của session vẫn còn hoạt động
+SESSION_TIMEOUT = timedelta(minutes=CONTEXT_TIMEOUT_MINUTES)
+expiry_heap = []
+expiry_lock = threading.Lock()
+
+
+def touch_session(session_id):
+    """Cập nhật last_activity, đưa session về cuối LRU và lên lịch hết hạn"""
+    now = datetime.now()
+    conversations[session_id]['last_activity'] = now
+    conversations.move_to_end(session_id)
+    with expiry_lock:
+        heapq.heappush(expiry_heap, (now + SESSION_TIMEOUT, session_id))
+    evict_idle_sessions(keep=session_id)
+
+
+def evict_idle_sessions(keep=None):
+    """Giữ tối đa MAX_SESSIONS session trong bộ nhớ: bỏ các session ít hoạt động nhất (đầu LRU)"""
+    attempts = len(conversations)
+    while len(conversations) > MAX_SESSIONS and attempts > 0:
+        attempts -= 1
+        try:
+            session_id = next(iter(conversations))
+        except (StopIteration, RuntimeError):
+            break
+        
+        # Chỉ bỏ session khi giữ được lock của nó: request đang dùng session sẽ không gặp KeyError
+        lock = session_lock(session_id)
+        if session_id == keep or not lock.acquire(blocking=False):
+            try:
+                conversations.move_to_end(session_id)  # đang bận → coi như vừa hoạt động
+            except KeyError:
+                pass
+            continue
+        try:
+            conversations.pop(session_id, None)
+        finally:
+            lock.release()
+        logger.info(f"🧹 Evicted least recently used session: {session_id}")
+
+
+# Ghi MySQL chạy nền để request không phải chờ DB; 1 thread để giữ đúng thứ tự ghi
+db_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+
+# Tóm tắt lịch sử chạy nền (gọi OpenAI), không chặn request
+compaction_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="compaction")
+
+COMPACTION_PROMPT = (
+    "Summarize the conversation turns below in at most 200 tokens, in the language the user uses. "
+    "Preserve the child's name, preferences, decisions, facts already explained and unresolved questions."
+)
+
+# time.monotonic() sớm nhất được thử tóm tắt lại sau lần lỗi gần nhất (dùng chung mọi session)
+compaction_backoff = {'retry_at': 0.0}
+
+
+def persist(db_call, *args):
+    """Đưa một lệnh ghi database vào hàng đợi background"""
+    def run():
+        try:
+            db_call(*args)
+        except Exception as e:
+            logger.error(f"❌ Background database write failed: {e}")
+    
+    db_writer.submit(run)
+
+
+def persist_to_stores(method, *args):
+    """Gọi cùng một lệnh ghi (save_session, save_message, replace_messages, delete_session) trên mọi session store"""
+    for store in session_stores:
+        persist(getattr(store, method), *args)
+
+
+def estimate_tokens(text):
+    """Ước lượng số token (~4 ký tự/token), tính một lần khi thêm tin nhắn"""
+    return (len(text) + 3) // 4
 
 
 class ConversationManager:
@@ -117,239 +412,454 @@ class ConversationManager:
     @staticmethod
     def get_or_create_session(session_id=None, preferred_lang=None, preferred_voice=None):
         """Lấy hoặc tạo session ID mới"""
-        if session_id and session_id in conversations:
-            conversations[session_id]['last_activity'] = datetime.now()
-            if preferred_lang:
-                conversations[session_id]['language'] = preferred_lang
-            if preferred_voice:
-                conversations[session_id]['voice'] = preferred_voice
+        with session_lock(session_id):
+            if session_id and session_id in conversations:
+                touch_session(session_id)
+                if preferred_lang:
+                    conversations[session_id]['language'] = preferred_lang
+                if preferred_voice:
+                    conversations[session_id]['voice'] = preferred_voice
+                
+                # Lưu vào DB
+                persist_to_stores('save_session', session_id, conversations[session_id])
+                
+                return session_id
             
-            # Lưu vào DB
-            if CONTEXT_PERSIST and db:
-                db.save_session(session_id, conversations[session_id])
+            # Load từ Redis / database nếu tồn tại
+            for store in session_stores if session_id else ():
+                loaded_data = store.load_session(session_id)
+                if loaded_data:
+                    # System prompt giữ riêng, lịch sử là deque giới hạn độ dài
+                    loaded_data['system'] = get_system_message(loaded_data['language'])
+                    history = [msg for msg in loaded_data['messages'] if msg['role'] != 'system']
+                    loaded_data['messages'] = deque(history, maxlen=CONTEXT_MAX_MESSAGES)
+                    loaded_data['token_counts'] = deque(
+                        (estimate_tokens(msg['content']) for msg in history), maxlen=CONTEXT_MAX_MESSAGES
+                    )
+                    loaded_data['total_tokens'] = sum(loaded_data['token_counts'])
+                    loaded_data['message_count'] = len(history)
+                    loaded_data['created_at_iso'] = loaded_data['created_at'].isoformat()
+                    conversations[session_id] = loaded_data
+                    touch_session(session_id)
+                    logger.info(f"📂 Loaded session from database: {session_id}")
+                    return session_id
             
-            return session_id
-        
-        # Load từ database nếu tồn tại
-        if session_id and CONTEXT_PERSIST and db:
-            loaded_data = db.load_session(session_id)
-            if loaded_data:
-                conversations[session_id] = loaded_data
-                conversations[session_id]['last_activity'] = datetime.now()
-                logger.info(f"📂 Loaded session from database: {session_id}")
-                return session_id
-        
-        # Tạo session mới
-        new_session_id = session_id or secrets.token_hex(16)
-        lang = preferred_lang or BOT_LANGUAGE
-        voice = preferred_voice or VOICE_MAP.get(lang, OPENAI_VOICE)
-        
-        system_prompt_template = get_response_template('system', lang)
-        final_system_prompt = system_prompt_template.replace("{{CUSTOM_INSTRUCTIONS}}", CUSTOM_PROMPT_ADDITIONS)
-        
-        greeting_message = get_response_template('greeting', lang)
-        
-        conversations[new_session_id] = {
-            'messages': [{"role": "system", "content": final_system_prompt}],
-            'language': lang,
-            'voice': voice,
-            'created_at': datetime.now(),
-            'last_activity': datetime.now(),
-            'metadata': {
-                'title': f"Conversation {datetime.now().strftime('%Y-%m-%d %H:%M')}",
-                'initial_greeting': greeting_message
+            # Tạo session mới
+            new_session_id = session_id or secrets.token_urlsafe(12)
+            lang = preferred_lang or BOT_LANGUAGE
+            voice = preferred_voice or VOICE_MAP.get(lang, OPENAI_VOICE)
+            
+            final_system_prompt = get_system_prompt(lang)
+            
+            greeting_message = GREETINGS.get(lang, GREETINGS['vi'])
+            now = datetime.now()
+            
+            conversations[new_session_id] = {
+                'system': get_system_message(lang),
+                'messages': deque(maxlen=CONTEXT_MAX_MESSAGES),
+                'token_counts': deque(maxlen=CONTEXT_MAX_MESSAGES),
+                'total_tokens': 0,
+                'message_count': 0,
+                'language': lang,
+                'voice': voice,
+                'created_at': now,
+                'created_at_iso': now.isoformat(),
+                'last_activity': now,
+                'metadata': {
+                    'title': f"Conversation {datetime.now().strftime('%Y-%m-%d %H:%M')}",
+                    'initial_greeting': greeting_message
+                }
             }
-        }
-        
-        logger.info(f"✅ Created new session: {new_session_id} (language: {lang}, voice: {voice})")
-        
-        # Lưu vào database
-        if CONTEXT_PERSIST and db:
-            db.save_session(new_session_id, conversations[new_session_id])
-            db.save_message(new_session_id, 'system', final_system_prompt)
-        
-        return new_session_id
+            
+            touch_session(new_session_id)
+            logger.info(f"✅ Created new session: {new_session_id} (language: {lang}, voice: {voice})")
+            
+            # Lưu vào database
+            persist_to_stores('save_session', new_session_id, conversations[new_session_id])
+            persist_to_stores('save_message', new_session_id, 'system', final_system_prompt)
+            
+            return new_session_id
     
     @staticmethod
     def add_message(session_id, role, content, tokens_used=0):
         """Thêm tin nhắn vào lịch sử"""
-        if session_id not in conversations:
-            ConversationManager.get_or_create_session(session_id)
-        
-        conversations[session_id]['messages'].append({"role": role, "content": content})
-        conversations[session_id]['last_activity'] = datetime.now()
-        
-        # Lưu vào database
-        if CONTEXT_PERSIST and db:
-            db.save_message(session_id, role, content, tokens_used)
-            db.save_session(session_id, conversations[session_id])
-        
-        messages = conversations[session_id]['messages']
-        if len(messages) > CONTEXT_MAX_MESSAGES + 1:
-            conversations[session_id]['messages'] = [messages[0]] + messages[-(CONTEXT_MAX_MESSAGES):]
-            logger.info(f"🔄 Trimmed context for session {session_id}")
+        with session_lock(session_id):
+            if session_id not in conversations:
+                ConversationManager.get_or_create_session(session_id)
+            
+            # deque(maxlen) tự bỏ tin nhắn cũ nhất khi đầy; token_counts song song với messages
+            session = conversations[session_id]
+            messages = session['messages']
+            token_counts = session['token_counts']
+            if len(messages) == messages.maxlen:
+                session['total_tokens'] -= token_counts[0]
+                logger.info(f"🔄 Trimmed context for session {session_id}")
+            tokens = estimate_tokens(content)
+            messages.append({"role": role, "content": content})
+            token_counts.append(tokens)
+            session['total_tokens'] += tokens
+            session['message_count'] += 1
+            
+            # Vượt token budget: bỏ tin nhắn cũ nhất, chỉ trừ số token đã lưu (không quét lại nội dung)
+            if CONTEXT_MAX_TOKENS > 0 and session['total_tokens'] > CONTEXT_MAX_TOKENS:
+                while session['total_tokens'] > CONTEXT_MAX_TOKENS and len(messages) > 1:
+                    messages.popleft()
+                    session['total_tokens'] -= token_counts.popleft()
+                logger.info(f"🔄 Trimmed context to {session['total_tokens']} tokens for session {session_id}")
+            
+            # Lịch sử vừa đầy: tóm tắt phần cũ ở background trước khi deque bắt đầu bỏ tin nhắn
+            if (COMPACTION_ENABLED and client and not session.get('compacting')
+                    and len(messages) == messages.maxlen and len(messages) > COMPACTION_KEEP_RECENT + 1
+                    and time.monotonic() >= compaction_backoff['retry_at']):
+                session['compacting'] = True
+                compaction_pool.submit(
+                    ConversationManager.compact_history, session_id, list(messages)[:-COMPACTION_KEEP_RECENT]
+                )
+            touch_session(session_id)
+            
+            # Lưu vào database
+            persist_to_stores('save_message', session_id, role, content, tokens_used)
+            persist_to_stores('save_session', session_id, conversations[session_id])
+    
+    @staticmethod
+    def compact_history(session_id, old_messages):
+        """
+        Thay old_messages (đầu lịch sử) bằng một tin nhắn "[Previously: ...]".
+        Nếu gọi OpenAI lỗi hoặc các tin nhắn đó đã bị bỏ trong lúc chờ → giữ cách cắt cũ.
+        Lỗi → không tóm tắt (ở mọi session) trong COMPACTION_RETRY_SECONDS để sự cố không nhân số lần gọi API.
+        """
+        summary = None
+        try:
+            response = client.chat.completions.create(
+                model=OPENAI_MODEL,
+                messages=[{"role": "system", "content": COMPACTION_PROMPT}, *old_messages],
+                max_tokens=220,
+                temperature=0.2
+            )
+            summary = response.choices[0].message.content
+        except Exception as e:
+            compaction_backoff['retry_at'] = time.monotonic() + COMPACTION_RETRY_SECONDS
+            logger.error(f"❌ Context compaction failed for session {session_id}: {e} "
+                         f"(retry in {COMPACTION_RETRY_SECONDS}s)")
+        
+        with session_lock(session_id):
+            session = conversations.get(session_id)
+            if not session:
+                return
+            session['compacting'] = False
+            messages = session['messages']
+            token_counts = session['token_counts']
+            # So sánh theo identity: tin nhắn cuối của phần cũ phải còn trong lịch sử
+            last_old = old_messages[-1]
+            drop = next((i + 1 for i, msg in enumerate(messages) if msg is last_old), 0)
+            if not summary or not drop:
+                return
+            
+            for _ in range(drop):
+                messages.popleft()
+                session['total_tokens'] -= token_counts.popleft()
+            content = f"[Previously: {summary}]"
+            tokens = estimate_tokens(content)
+            messages.appendleft({"role": "assistant", "content": content})
+            token_counts.appendleft(tokens)
+            session['total_tokens'] += tokens
+            logger.info(f"🗜️ Compacted {drop} messages into a summary for session {session_id}")
+            
+            # Ghi đè lịch sử đã lưu để session load lại (restart / LRU) vẫn có tóm tắt
+            persist_to_stores('replace_messages', session_id, list(messages))
     
     @staticmethod
     def get_messages(session_id):
-        """Lấy toàn bộ lịch sử tin nhắn"""
-        if session_id not in conversations:
-            ConversationManager.get_or_create_session(session_id)
-        return conversations[session_id]['messages']
+        """Lấy toàn bộ lịch sử tin nhắn (system prompt + lịch sử) để gửi OpenAI"""
+        with session_lock(session_id):
+            if session_id not in conversations:
+                ConversationManager.get_or_create_session(session_id)
+            session = conversations[session_id]
+            return [session['system'], *session['messages']]
+    
+    @staticmethod
+    def get_context_length(session_id):
+        """Số tin nhắn gửi OpenAI (system + lịch sử) mà không copy list, không tạo lại session đã bị xoá"""
+        session = conversations.get(session_id)
+        return 1 + len(session['messages']) if session else 0
     
     @staticmethod
     def get_language(session_id):
         """Lấy ngôn ngữ hiện tại của session"""
-        if session_id in conversations:
-            return conversations[session_id].get('language', BOT_LANGUAGE)
-        return BOT_LANGUAGE
+        session = conversations.get(session_id)
+        return session.get('language', BOT_LANGUAGE) if session else BOT_LANGUAGE
     
     @staticmethod
     def get_voice(session_id):
         """Lấy voice hiện tại của session"""
-        if session_id in conversations:
-            return conversations[session_id].get('voice', OPENAI_VOICE)
-        return OPENAI_VOICE
+        session = conversations.get(session_id)
+        return session.get('voice', OPENAI_VOICE) if session else OPENAI_VOICE
     
     @staticmethod
     def get_greeting(session_id):
         """Lấy greeting message của session"""
-        if session_id in conversations:
-            return conversations[session_id].get('metadata', {}).get('initial_greeting', '')
-        return ''
+        session = conversations.get(session_id)
+        return session.get('metadata', {}).get('initial_greeting', '') if session else ''
     
     @staticmethod
     def set_language(session_id, language):
         """Thay đổi ngôn ngữ của session và cập nhật system prompt"""
-        if session_id in conversations:
-            conversations[session_id]['language'] = language
-            new_system_prompt = get_response_template('system', language)
-            new_system_prompt = new_system_prompt.replace("{{CUSTOM_INSTRUCTIONS}}", CUSTOM_PROMPT_ADDITIONS)
-            conversations[session_id]['messages'][0] = {"role": "system", "content": new_system_prompt}
-            
-            if 'voice_override' not in conversations[session_id]:
-                conversations[session_id]['voice'] = VOICE_MAP.get(language, OPENAI_VOICE)
-            
-            logger.info(f"🌐 Session {session_id} switched to language: {language}")
-            
-            if CONTEXT_PERSIST and db:
-                db.save_session(session_id, conversations[session_id])
-            
-            return True
-        return False
+        with session_lock(session_id):
+            if session_id in conversations:
+                conversations[session_id]['language'] = language
+                conversations[session_id]['system'] = get_system_message(language)
+                
+                # Session load từ Redis/MySQL luôn có key voice_override (có thể False) → kiểm tra giá trị
+                if not conversations[session_id].get('voice_override'):
+                    conversations[session_id]['voice'] = VOICE_MAP.get(language, OPENAI_VOICE)
+                
+                logger.info(f"🌐 Session {session_id} switched to language: {language}")
+                
+                persist_to_stores('save_session', session_id, conversations[session_id])
+                
+                return True
+            return False
     
     @staticmethod
     def set_voice(session_id, voice):
         """Thay đổi giọng nói của session"""
-        if session_id in conversations:
-            conversations[session_id]['voice'] = voice
-            conversations[session_id]['voice_override'] = True
-            logger.info(f"🎤 Session {session_id} switched to voice: {voice}")
-            
-            if CONTEXT_PERSIST and db:
-                db.save_session(session_id, conversations[session_id])
-            
-            return True
-        return False
+        with session_lock(session_id):
+            if session_id in conversations:
+                conversations[session_id]['voice'] = voice
+                conversations[session_id]['voice_override'] = True
+                logger.info(f"🎤 Session {session_id} switched to voice: {voice}")
+                
+                persist_to_stores('save_session', session_id, conversations[session_id])
+                
+                return True
+            return False
     
     @staticmethod
     def clear_session(session_id):
         """Xóa session"""
-        if session_id in conversations:
-            del conversations[session_id]
-            logger.info(f"🗑️ Cleared session: {session_id}")
-            
-            if CONTEXT_PERSIST and db:
-                db.delete_session(session_id)
-            
-            return True
-        return False
+        with session_lock(session_id):
+            if conversations.pop(session_id, None) is not None:
+                logger.info(f"🗑️ Cleared session: {session_id}")
+                
+                persist_to_stores('delete_session', session_id)
+                
+                return True
+            return False
     
     @staticmethod
-    def cleanup_old_sessions():
-        """Xóa các session không hoạt động"""
+    def expire_sessions():
+        """Xóa các session đã hết hạn trong bộ nhớ: chỉ pop các entry tới hạn của expiry_heap"""
         now = datetime.now()
-        timeout = timedelta(minutes=CONTEXT_TIMEOUT_MINUTES)
-        
-        # Cleanup in-memory
-        expired_sessions = [
-            sid for sid, data in conversations.items()
-            if now - data['last_activity'] > timeout
-        ]
-        for sid in expired_sessions:
-            del conversations[sid]
+        expired_sessions = []
+        
+        while True:
+            with expiry_lock:
+                if not expiry_heap or expiry_heap[0][0] > now:
+                    break
+                _, sid = heapq.heappop(expiry_heap)
+            
+            # Entry cũ của session vẫn còn hoạt động (đã có entry mới hơn trong heap) → bỏ qua
+            with session_lock(sid):
+                data = conversations.get(sid)
+                if not data or now - data['last_activity'] < SESSION_TIMEOUT:
+                    continue
+                conversations.pop(sid, None)
+            expired_sessions.append(sid)
             logger.info(f"⏰ Auto-deleted expired session: {sid}")
         
+        return len(expired_sessions)
+    
+    @staticmethod
+    def seconds_until_next_expiry(max_wait):
+        """Thời gian tới entry hết hạn sớm nhất (tối đa max_wait giây)"""
+        with expiry_lock:
+            if not expiry_heap:
+                return max_wait
+            next_deadline = expiry_heap[0][0]
+        wait = (next_deadline - datetime.now()).total_seconds()
+        return min(max(wait, 1.0), max_wait)
+    
+    @staticmethod
+    def cleanup_old_sessions():
+        """Xóa các session không hoạt động (bộ nhớ và database)"""
+        expired_count = ConversationManager.expire_sessions()
+        
         # Cleanup database
         if CONTEXT_PERSIST and db:
             db.cleanup_old_sessions(CONTEXT_TIMEOUT_MINUTES)
         
-        return len(expired_sessions)
+        return expired_count
 
 
+def session_janitor():
+    """Background thread: ngủ tới hạn hết hạn gần nhất rồi dọn session, ngoài request path"""
+    interval = CONTEXT_TIMEOUT_MINUTES * 60 / 2
+    last_db_cleanup = time.monotonic()
+    while True:
+        time.sleep(ConversationManager.seconds_until_next_expiry(interval))
+        try:
+            ConversationManager.expire_sessions()
+            
+            # Database dọn theo chu kỳ cố định
+            if CONTEXT_PERSIST and db and time.monotonic() - last_db_cleanup >= interval:
+                last_db_cleanup = time.monotonic()
+                db.cleanup_old_sessions(CONTEXT_TIMEOUT_MINUTES)
+        except Exception as e:
+            logger.error(f"❌ Session cleanup failed: {e}")
 
-# ============================================
-# LANGUAGE & VOICE DETECTION
-# ============================================
 
-def detect_language(text):
-    """
-    Nhận diện ngôn ngữ dựa trên bộ ký tự
-    Improved version: Kiểm tra tỷ lệ thay vì chỉ có/không có
-    """
-    vietnamese_chars = 'àáảãạăằắẳẵặâầấẩẫậèéẻẽẹêềếểễệìíỉĩịòóỏõọôồốổỗộơờớởỡợùúủũụưừứửữựỳýỷỹỵđ'
-    text_lower = text.lower()
-    
-    # Đếm số lượng ký tự mỗi loại
-    vi_char_count = sum(1 for char in text_lower if char in vietnamese_chars)
-    en_char_count = sum(1 for char in text_lower if char.isalpha() and char.isascii())
-    total_alpha = sum(1 for char in text_lower if char.isalpha())
-    
-    if total_alpha == 0:
-        return 'auto'
-    
-    # Tính tỷ lệ
-    vi_ratio = vi_char_count / total_alpha
-    en_ratio = en_char_count / total_alpha
-    
-    # Quyết định dựa trên tỷ lệ
-    if vi_ratio > 0.1:  # Nếu >10% là ký tự tiếng Việt → tiếng Việt
-        return 'vi'
-    elif en_ratio > 0.5:  # Nếu >50% là ký tự ASCII → tiếng Anh
-        return 'en'
-    else:
-        return 'auto'
+threading.Thread(target=session_janitor, name="session-janitor", daemon=True).start()
 
 
-def detect_language_switch_intent(user_message):
-    """
-    Phát hiện ý định chuyển ngôn ngữ
-    Returns: (target_language, is_switch_request)
-    """
-    message_lower = user_message.lower().strip()
+# File debug audio: xoá file cũ hơn MAX_AGE, sau đó xoá file cũ nhất tới khi tổng dung lượng < MAX_MB
+DEBUG_AUDIO_DIR = os.path.abspath(os.getenv("DEBUG_AUDIO_DIR", "debug_audio"))
+DEBUG_AUDIO_MAX_AGE = int(os.getenv("DEBUG_AUDIO_MAX_AGE", "3600"))
+DEBUG_AUDIO_MAX_MB = int(os.getenv("DEBUG_AUDIO_MAX_MB", "512"))
+DEBUG_AUDIO_PRUNE_INTERVAL = 300
+
+
+def prune_debug_audio():
+    """Dọn DEBUG_AUDIO_DIR theo tuổi và tổng dung lượng (LRU theo mtime)"""
+    if not os.path.isdir(DEBUG_AUDIO_DIR):
+        return 0
+    
+    now = time.time()
+    entries = []
+    # scandir: một lần stat cho mỗi file
+    with os.scandir(DEBUG_AUDIO_DIR) as it:
+        for entry in it:
+            if entry.is_file(follow_symlinks=False):
+                st = entry.stat(follow_symlinks=False)
+                entries.append((st.st_mtime, st.st_size, entry.path))
+    
+    entries.sort()
+    total_size = sum(size for _, size, _ in entries)
+    max_bytes = DEBUG_AUDIO_MAX_MB * 1024 * 1024
+    deleted = 0
+    
+    for mtime, size, path in entries:
+        if now - mtime <= DEBUG_AUDIO_MAX_AGE and total_size <= max_bytes:
+            break
+        try:
+            os.unlink(path)
+            deleted += 1
+        except FileNotFoundError:
+            pass
+        total_size -= size
     
+    if deleted:
+        logger.info(f"🧹 Pruned {deleted} debug audio file(s)")
+    return deleted
+
+
+def audio_janitor():
+    """Background thread: dọn debug_audio/ định kỳ"""
+    while True:
+        try:
+            prune_debug_audio()
+        except Exception as e:
+            logger.error(f"❌ Debug audio cleanup failed: {e}")
+        time.sleep(DEBUG_AUDIO_PRUNE_INTERVAL)
+
+
+threading.Thread(target=audio_janitor, name="audio-janitor", daemon=True).start()
+
+
+# ============================================
+# LANGUAGE & VOICE DETECTION
+# ============================================
+
+# Yêu cầu chuyển ngôn ngữ: kiểm tra theo thứ tự (tiếng Anh trước, rồi tiếng Việt)
+LANGUAGE_SWITCH_TRIGGERS = {
     # Yêu cầu chuyển sang tiếng Anh
-    en_triggers = [
+    'en': [
         'speak english', 'talk in english', 'use english', 'switch to english',
         'answer in english', 'reply in english', 'say it in english',
         'hãy nói tiếng anh', 'nói tiếng anh', 'chuyển sang tiếng anh', 
         'dùng tiếng anh', 'trả lời bằng tiếng anh', 'đổi sang tiếng anh'
-    ]
+    ],
     
     # Yêu cầu chuyển sang tiếng Việt
-    vi_triggers = [
+    'vi': [
         'speak vietnamese', 'talk in vietnamese', 'use vietnamese', 
         'switch to vietnamese', 'answer in vietnamese', 'reply in vietnamese',
         'hãy nói tiếng việt', 'nói tiếng việt', 'chuyển sang tiếng việt', 
         'dùng tiếng việt', 'trả lời bằng tiếng việt', 'đổi sang tiếng việt'
     ]
+}
+
+# Yêu cầu đổi giọng: thứ tự dict là thứ tự ưu tiên (vd: 'giọng nữ mềm' khớp 'giọng nữ' → nova)
+VOICE_CHANGE_TRIGGERS = {
+    'nova': [
+        'giọng nữ', 'giọng gái', 'giọng con gái',
+        'female voice', 'woman voice', 'girl voice', 
+        'dùng giọng nữ', 'chuyển giọng nữ', 'đổi giọng nữ',
+        'use female voice', 'switch to female', 'change to female voice',
+        'giọng nova', 'voice nova', 'use nova'
+    ],
+    
+    'shimmer': [
+        'giọng nữ mềm', 'giọng nữ nhẹ nhàng',
+        'soft female voice', 'gentle female voice',
+        'giọng shimmer', 'voice shimmer', 'use shimmer'
+    ],
     
-    for trigger in en_triggers:
-        if trigger in message_lower:
-            return ('en', True)
+    'onyx': [
+        'giọng nam', 'giọng trai', 'giọng con trai',
+        'male voice', 'man voice', 'boy voice',
+        'dùng giọng nam', 'chuyển giọng nam', 'đổi giọng nam',
+        'use male voice', 'switch to male', 'change to male voice',
+        'giọng onyx', 'voice onyx', 'use onyx'
+    ],
     
-    for trigger in vi_triggers:
-        if trigger in message_lower:
-            return ('vi', True)
+    'echo': [
+        'giọng nam echo', 'giọng echo',
+        'voice echo', 'use echo'
+    ],
+    
+    'fable': [
+        'giọng fable', 'voice fable', 'use fable'
+    ],
+    
+    'alloy': [
+        'giọng trung tính', 'giọng neutral',
+        'neutral voice', 'default voice',
+        'giọng alloy', 'voice alloy', 'use alloy'
+    ]
+}
+
+
+def compile_triggers(triggers_by_key):
+    """
+    Returns: (any_pattern, [(key, pattern)...]) — any_pattern là một regex alternation của mọi
+    trigger để loại nhanh câu bình thường (đa số), pattern từng key giữ đúng thứ tự ưu tiên
+    """
+    any_pattern = re.compile('|'.join(
+        re.escape(trigger) for triggers in triggers_by_key.values() for trigger in triggers
+    ))
+    key_patterns = tuple(
+        (key, re.compile('|'.join(map(re.escape, triggers))))
+        for key, triggers in triggers_by_key.items()
+    )
+    return any_pattern, key_patterns
+
+
+LANGUAGE_SWITCH_ANY, LANGUAGE_SWITCH_PATTERNS = compile_triggers(LANGUAGE_SWITCH_TRIGGERS)
+VOICE_CHANGE_ANY, VOICE_CHANGE_PATTERNS = compile_triggers(VOICE_CHANGE_TRIGGERS)
+
+
+def detect_language_switch_intent(user_message):
+    """
+    Phát hiện ý định chuyển ngôn ngữ
+    Returns: (target_language, is_switch_request)
+    """
+    message_lower = user_message.lower().strip()
+    if not LANGUAGE_SWITCH_ANY.search(message_lower):
+        return (None, False)
+    
+    for language, pattern in LANGUAGE_SWITCH_PATTERNS:
+        if pattern.search(message_lower):
+            return (language, True)
     
     return (None, False)
 
@@ -360,50 +870,12 @@ def detect_voice_change_intent(user_message):
     Returns: (voice_name, is_voice_change_request)
     """
     message_lower = user_message.lower().strip()
+    if not VOICE_CHANGE_ANY.search(message_lower):
+        return (None, False)
     
-    voice_mappings = {
-        'nova': [
-            'giọng nữ', 'giọng gái', 'giọng con gái',
-            'female voice', 'woman voice', 'girl voice', 
-            'dùng giọng nữ', 'chuyển giọng nữ', 'đổi giọng nữ',
-            'use female voice', 'switch to female', 'change to female voice',
-            'giọng nova', 'voice nova', 'use nova'
-        ],
-        
-        'shimmer': [
-            'giọng nữ mềm', 'giọng nữ nhẹ nhàng',
-            'soft female voice', 'gentle female voice',
-            'giọng shimmer', 'voice shimmer', 'use shimmer'
-        ],
-        
-        'onyx': [
-            'giọng nam', 'giọng trai', 'giọng con trai',
-            'male voice', 'man voice', 'boy voice',
-            'dùng giọng nam', 'chuyển giọng nam', 'đổi giọng nam',
-            'use male voice', 'switch to male', 'change to male voice',
-            'giọng onyx', 'voice onyx', 'use onyx'
-        ],
-        
-        'echo': [
-            'giọng nam echo', 'giọng echo',
-            'voice echo', 'use echo'
-        ],
-        
-        'fable': [
-            'giọng fable', 'voice fable', 'use fable'
-        ],
-        
-        'alloy': [
-            'giọng trung tính', 'giọng neutral',
-            'neutral voice', 'default voice',
-            'giọng alloy', 'voice alloy', 'use alloy'
-        ]
-    }
-    
-    for voice, triggers in voice_mappings.items():
-        for trigger in triggers:
-            if trigger in message_lower:
-                return (voice, True)
+    for voice, pattern in VOICE_CHANGE_PATTERNS:
+        if pattern.search(message_lower):
+            return (voice, True)
     
     return (None, False)
 
@@ -412,17 +884,59 @@ def detect_voice_change_intent(user_message):
 # AUDIO PROCESSING
 # ============================================
 
-def transcribe_audio(audio_data):
-    """Transcribe audio using OpenAI Whisper API"""
+def read_raw_pcm(stream, sample_rate=16000, channels=1):
+    """
+    Chép PCM 16-bit thô từ stream vào BytesIO ngay sau WAV header (theo chunk,
+    không giữ thêm bản sao toàn bộ audio). Stream đã có RIFF header thì giữ nguyên.
+    """
+    head = stream.read(4)
+    has_header = head == b'RIFF'
+    buffer = io.BytesIO()
+    if not has_header:
+        buffer.write(create_wav_header(0, sample_rate, channels, 16))
+    buffer.write(head)
+    shutil.copyfileobj(stream, buffer, 64 * 1024)
+    
+    if not has_header:
+        data_size = buffer.tell() - WAV_HEADER_STRUCT.size
+        with buffer.getbuffer() as view:
+            WAV_SIZE_FIELD.pack_into(view, 4, data_size + 36)
+            WAV_SIZE_FIELD.pack_into(view, 40, data_size)
+    
+    buffer.seek(0)
+    return buffer
+
+
+def wav_rms(wav_data):
+    """RMS của PCM 16-bit trong WAV (None nếu không đọc được data chunk)"""
+    data_offset = bytes(wav_data[:512]).find(b'data', 12)
+    if data_offset < 0:
+        return None
+    pcm = memoryview(wav_data)[data_offset + 8:]
+    pcm = pcm[:len(pcm) - len(pcm) % 2]
+    if not pcm:
+        return 0.0
+    
+    if np is not None:
+        samples = np.frombuffer(pcm, dtype='<i2').astype(np.float32)
+        return float(np.sqrt(np.mean(samples * samples)))
+    
+    samples = array('h')
+    samples.frombytes(pcm)
+    if sys.byteorder == 'big':
+        samples.byteswap()
+    return math.sqrt(math.fsum(x * x for x in samples) / len(samples))
+
+
+def transcribe_audio(audio_data, filename='audio.wav', mimetype='audio/wav'):
+    """Transcribe audio using OpenAI Whisper API (WAV, Ogg/Opus, FLAC... gửi nguyên định dạng)"""
     try:
-        logger.info("🎤 Transcribing audio with Whisper...")
-        audio_file = io.BytesIO(audio_data)
-        audio_file.name = "audio.wav"
+        logger.info(f"🎤 Transcribing audio with Whisper ({mimetype})...")
         lang_param = BOT_LANGUAGE if BOT_LANGUAGE != 'auto' else None
         
         transcript = client.audio.transcriptions.create(
             model="whisper-1",
-            file=audio_file,
+            file=(filename, audio_data, mimetype),
             language=lang_param
         )
         
@@ -435,7 +949,7 @@ def transcribe_audio(audio_data):
         raise
 
 
-def get_chat_response(user_message, session_id='default', return_greeting=False):
+def get_chat_response(user_message, session_id='default', return_greeting=False, stream=False, classification=None):
     """
     Get AI response with intelligent language and voice handling
     
@@ -443,14 +957,17 @@ def get_chat_response(user_message, session_id='default', return_greeting=False)
         user_message: User's input text
         session_id: Session identifier
         return_greeting: If True and it's first message, return greeting instead
+        stream: If True, return a generator of text chunks for OpenAI replies
+                (canned replies are still returned as a plain string)
+        classification: (language, is_safe) nếu caller đã gọi classify(), tránh quét lại
     """
     try:
         logger.info(f"🤖 Getting AI response for: {user_message}")
         
-        detected_lang = detect_language(user_message)
+        detected_lang, is_safe = classification or classify(user_message)
         
-        if not is_safe_content(user_message):
-            return get_response_template('inappropriate', detected_lang)
+        if not is_safe:
+            return INAPPROPRIATE_RESPONSES[detected_lang]
         
         (target_voice, is_voice_change) = detect_voice_change_intent(user_message)
         (target_lang, is_lang_switch) = detect_language_switch_intent(user_message)
@@ -458,11 +975,9 @@ def get_chat_response(user_message, session_id='default', return_greeting=False)
         if CONTEXT_ENABLED:
             session_id = ConversationManager.get_or_create_session(session_id)
             current_lang = ConversationManager.get_language(session_id)
-            current_voice = ConversationManager.get_voice(session_id)
             
             # Nếu là lần đầu tiên và yêu cầu greeting
-            messages = ConversationManager.get_messages(session_id)
-            if return_greeting and len(messages) == 1:  # Chỉ có system message
+            if return_greeting and ConversationManager.get_context_length(session_id) == 1:  # Chỉ có system message
                 greeting = ConversationManager.get_greeting(session_id)
                 if greeting:
                     ConversationManager.add_message(session_id, "assistant", greeting)
@@ -506,38 +1021,64 @@ def get_chat_response(user_message, session_id='default', return_greeting=False)
                 logger.info(f"🌐 Language switched to {target_lang} for session {session_id}")
                 return confirmation
             
-            # Tự động nhận diện ngôn ngữ input
-            detected_input_lang = detect_language(user_message)
+            # Tự động nhận diện ngôn ngữ input (dùng lại kết quả classify() ở trên)
+            if detected_lang != 'auto' and detected_lang != current_lang:
+                logger.info(f"🌐 Auto-switching language from {current_lang} to {detected_lang}")
+                ConversationManager.set_language(session_id, detected_lang)
             
-            if detected_input_lang != 'auto' and detected_input_lang != current_lang:
-                logger.info(f"🌐 Auto-switching language from {current_lang} to {detected_input_lang}")
-                ConversationManager.set_language(session_id, detected_input_lang)
+            # Câu trả lời phụ thuộc lịch sử hội thoại → chỉ dùng cache cho lượt đầu (chưa có lượt nào trước đó),
+            # không thì session này có thể nhận câu trả lời dựa trên lịch sử của session khác
+            if ConversationManager.get_context_length(session_id) == 1:
+                reply_key = reply_cache_key(user_message, ConversationManager.get_language(session_id))
+            else:
+                reply_key = None
+            cached_reply = reply_cache.get(reply_key) if reply_key else None
             
-            ConversationManager.add_message(session_id, "user", user_message)
+            if cached_reply:
+                ConversationManager.add_message(session_id, "user", user_message)
+                ConversationManager.add_message(session_id, "assistant", cached_reply)
+                logger.info(f"♻️ Reply cache hit (session: {session_id})")
+                return cached_reply
+            # Lượt user chỉ ghi vào lịch sử cùng với câu trả lời (OpenAI lỗi / client ngắt thì không để lại lượt lẻ)
             messages = ConversationManager.get_messages(session_id)
+            messages.append({"role": "user", "content": user_message})
             
         else:
-            session_id = ConversationManager.get_or_create_session()
-            system_prompt_template = get_response_template('system', detected_lang if detected_lang != 'auto' else BOT_LANGUAGE)
-            final_system_prompt = system_prompt_template.replace("{{CUSTOM_INSTRUCTIONS}}", CUSTOM_PROMPT_ADDITIONS)
+            reply_lang = detected_lang if detected_lang != 'auto' else BOT_LANGUAGE
+            reply_key = reply_cache_key(user_message, reply_lang)
+            cached_reply = reply_cache.get(reply_key) if reply_key else None
+            if cached_reply:
+                logger.info("♻️ Reply cache hit")
+                return cached_reply
+            
             messages = [
-                {"role": "system", "content": final_system_prompt},
+                get_system_message(reply_lang),
                 {"role": "user", "content": user_message}
             ]
         
         logger.info(f"📝 Sending {len(messages)} messages to OpenAI (session: {session_id})")
         
+        if stream:
+            return stream_chat_completion(messages, session_id, reply_key)
+        
         response = client.chat.completions.create(
             model=OPENAI_MODEL,
             messages=messages,
             max_tokens=MAX_TOKENS,
-            temperature=TEMPERATURE
+            temperature=TEMPERATURE,
+            extra_body=prompt_cache_body(messages)
         )
         
         assistant_message = response.choices[0].message.content
+        cache_details = getattr(response.usage, 'prompt_tokens_details', None)
+        if cache_details and cache_details.cached_tokens:
+            logger.debug(f"Prompt cache hit: {cache_details.cached_tokens} cached tokens")
         
         if CONTEXT_ENABLED:
+            ConversationManager.add_message(session_id, "user", user_message)
             ConversationManager.add_message(session_id, "assistant", assistant_message)
+        if reply_key:
+            reply_cache.set(reply_key, assistant_message)
         
         logger.info(f"✓ AI Response: {assistant_message}")
         return assistant_message
@@ -547,59 +1088,270 @@ def get_chat_response(user_message, session_id='default', return_greeting=False)
         raise
 
 
+def stream_chat_completion(messages, session_id, reply_key=None):
+    """
+    Stream chat completion deltas from OpenAI.
+    Gộp các delta thành batch (tăng gấp đôi từ STREAM_MIN_BATCH đến STREAM_MAX_BATCH)
+    để chunk đầu tiên đến nhanh nhưng không gửi quá nhiều chunk nhỏ.
+    Request tới OpenAI được gửi ngay khi gọi hàm (lỗi auth/quota raise trước khi caller
+    trả header HTTP); chỉ việc đọc delta nằm trong generator trả về.
+    Lượt user (messages[-1]) và câu trả lời đầy đủ chỉ được lưu vào context (và reply_cache
+    nếu có reply_key) khi stream kết thúc trọn vẹn.
+    """
+    response = client.chat.completions.create(
+        model=OPENAI_MODEL,
+        messages=messages,
+        max_tokens=MAX_TOKENS,
+        temperature=TEMPERATURE,
+        stream=True,
+        extra_body=prompt_cache_body(messages)
+    )
+    return stream_completion_deltas(response, messages[-1]['content'], session_id, reply_key)
+
+
+def stream_completion_deltas(response, user_message, session_id, reply_key=None):
+    """Generator đọc stream của stream_chat_completion, ghi cả lượt hội thoại khi xong"""
+    parts = []
+    pending = []
+    batch_size = STREAM_MIN_BATCH
+    
+    try:
+        for chunk in response:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if not delta:
+                continue
+            parts.append(delta)
+            pending.append(delta)
+            if len(pending) >= batch_size:
+                yield ''.join(pending)
+                pending = []
+                batch_size = min(batch_size * 2, STREAM_MAX_BATCH)
+    finally:
+        # Client ngắt giữa chừng (GeneratorExit) → đóng kết nối HTTP tới OpenAI
+        response.close()
+    
+    if pending:
+        yield ''.join(pending)
+    
+    assistant_message = ''.join(parts)
+    if CONTEXT_ENABLED:
+        ConversationManager.add_message(session_id, "user", user_message)
+        ConversationManager.add_message(session_id, "assistant", assistant_message)
+    if reply_key:
+        reply_cache.set(reply_key, assistant_message)
+    
+    logger.info(f"✓ AI Response (streamed): {assistant_message}")
+
+
+def sse_event(payload):
+    """Format a dict as a Server-Sent Events message"""
+    return f"data: {app.json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+def select_voice(text, language='auto', session_id=None):
+    """Chọn voice: ưu tiên voice của session, sau đó theo ngôn ngữ"""
+    if session_id and CONTEXT_ENABLED:
+        voice = ConversationManager.get_voice(session_id)
+        logger.info(f"🎤 Using session voice preference: {voice}")
+        return voice
+    if language == 'auto':
+        language = detect_language(text)
+    return VOICE_MAP.get(language, OPENAI_VOICE)
+
+
+# TTS đang chạy theo (text, voice): request trùng nhau đồng thời dùng chung một lần gọi
+tts_inflight = {}
+tts_inflight_lock = threading.Lock()
+
+
+def synthesize_pcm(text, voice):
+    """OpenAI TTS → raw PCM 16-bit mono 24kHz (gộp các request giống nhau đang chạy)"""
+    key = (text, voice)
+    with tts_inflight_lock:
+        pending = tts_inflight.get(key)
+        is_owner = pending is None
+        if is_owner:
+            pending = tts_inflight[key] = Future()
+    
+    if not is_owner:
+        logger.info(f"🔗 Coalesced TTS request (voice: {voice})")
+        return pending.result()
+    
+    try:
+        response = client.audio.speech.create(
+            model="tts-1",
+            voice=voice,
+            input=text,
+            response_format="pcm"
+        )
+        pcm_data = response.content
+        logger.info(f"✓ Received {len(pcm_data)} bytes of PCM audio")
+        pending.set_result(pcm_data)
+        return pcm_data
+    except Exception as e:
+        pending.set_exception(e)
+        raise
+    finally:
+        with tts_inflight_lock:
+            tts_inflight.pop(key, None)
+
+
+def resample_pcm(pcm_data, start=0):
+    """
+    Resample PCM 16-bit 24kHz → 16kHz: mẫu ra thứ k lấy tại mẫu vào floor(k * 1.5).
+    start: vị trí (tính theo mẫu) của pcm_data trong cả stream, để resample
+    từng chunk cho kết quả giống hệt resample cả đoạn một lần.
+    """
+    count = len(pcm_data) // 2
+    # Các mẫu ra k có floor(k * 1.5) nằm trong [start, start + count)
+    first = (2 * start + 2) // 3
+    end = (2 * (start + count) + 2) // 3
+    
+    if np is not None:
+        # Lấy mẫu bằng một phép gather của NumPy
+        pcm_16bit = np.frombuffer(pcm_data, dtype='<i2', count=count)
+        indices = np.arange(first, end, dtype=np.int64) * 3 // 2 - start
+        return pcm_16bit[indices].tobytes()
+    
+    # Không có NumPy: array('h') giữ mẫu dạng 2 byte (không tạo tuple int), và
+    # floor(k * 1.5) đúng là các mẫu có vị trí tuyệt đối % 3 != 2 → ghép hai slice bước 3
+    pcm_16bit = array('h')
+    pcm_16bit.frombytes(pcm_data[:count * 2])
+    if sys.byteorder == 'big':
+        pcm_16bit.byteswap()
+    phase0 = -start % 3          # vị trí cục bộ của mẫu đầu tiên có % 3 == 0
+    phase1 = (1 - start) % 3     # ... và % 3 == 1
+    lead, tail = (phase0, phase1) if phase0 < phase1 else (phase1, phase0)
+    resampled = array('h', bytes(2 * (end - first)))
+    resampled[0::2] = pcm_16bit[lead::3]
+    resampled[1::2] = pcm_16bit[tail::3]
+    if sys.byteorder == 'big':
+        resampled.byteswap()
+    return resampled.tobytes()
+
+
+# Bộ lọc chống alias 24kHz → 16kHz (up=2, down=3), cùng thiết kế với scipy.signal.resample_poly
+RESAMPLE_UP, RESAMPLE_DOWN = 2, 3
+RESAMPLE_HALF_LEN = 10 * RESAMPLE_DOWN
+RESAMPLE_TAPS = (
+    firwin(2 * RESAMPLE_HALF_LEN + 1, 1 / RESAMPLE_DOWN, window=('kaiser', 5.0)) * RESAMPLE_UP
+    if firwin is not None and np is not None else None
+)
+
+
+def resample_stream(pcm_chunks):
+    """
+    Resample các chunk PCM 16-bit 24kHz → 16kHz, yield bytes ngay khi có.
+    Có SciPy: lọc FIR polyphase, giữ trạng thái bộ lọc giữa các chunk nên kết quả
+    giống resample_poly trên cả đoạn. Không có: lấy mẫu gần nhất (resample_pcm).
+    """
+    position = 0
+    carry = b''
+    emitted = 0
+    zi = np.zeros(len(RESAMPLE_TAPS) - 1) if RESAMPLE_TAPS is not None else None
+    
+    def polyphase(samples):
+        # Chèn 0 (48kHz) → lọc → lấy mỗi mẫu thứ 3, bù trễ RESAMPLE_HALF_LEN của bộ lọc
+        nonlocal zi
+        offset = RESAMPLE_UP * position
+        upsampled = np.zeros(len(samples) * RESAMPLE_UP)
+        upsampled[::RESAMPLE_UP] = samples
+        filtered, zi = lfilter(RESAMPLE_TAPS, 1.0, upsampled, zi=zi)
+        first = max(RESAMPLE_HALF_LEN - offset, -offset % RESAMPLE_DOWN)
+        return filtered[first::RESAMPLE_DOWN]
+    
+    def to_pcm(samples):
+        return np.clip(np.rint(samples), -32768, 32767).astype('<i2').tobytes()
+    
+    for chunk in pcm_chunks:
+        if carry:
+            chunk = carry + chunk
+        # Chunk có thể cắt giữa một mẫu 16-bit → giữ byte lẻ cho chunk sau
+        usable = len(chunk) & ~1
+        carry = chunk[usable:]
+        if not usable:
+            continue
+        if RESAMPLE_TAPS is None:
+            resampled = resample_pcm(memoryview(chunk)[:usable], position)
+        else:
+            samples = np.frombuffer(chunk, dtype='<i2', count=usable // 2)
+            resampled = to_pcm(polyphase(samples))
+            emitted += len(resampled) // 2
+        position += usable // 2
+        if resampled:
+            yield resampled
+    
+    if RESAMPLE_TAPS is not None:
+        # Đẩy nốt phần đuôi còn trong bộ lọc, cắt đúng độ dài ceil(n * 2 / 3)
+        total = (RESAMPLE_UP * position + RESAMPLE_DOWN - 1) // RESAMPLE_DOWN
+        tail = polyphase(np.zeros(RESAMPLE_HALF_LEN // RESAMPLE_UP + 1))[:total - emitted]
+        if len(tail):
+            yield to_pcm(tail)
+
+
+def pcm_to_wav(pcm_data):
+    """Resample PCM 24kHz → 16kHz (cho ESP32) và thêm WAV header"""
+    resampled_pcm = b''.join(resample_stream((pcm_data,)))
+    logger.info(f"✓ Resampled to {len(resampled_pcm)} bytes at 16kHz")
+    
+    wav_header = create_wav_header(len(resampled_pcm), 16000, 1, 16)
+    return wav_header + resampled_pcm
+
+
+def stream_pcm_as_wav(pcm_chunks, on_complete=None):
+    """
+    Generator WAV 16kHz cho ESP32 từ các chunk PCM 24kHz: gửi header trước,
+    sau đó resample và gửi từng chunk ngay khi nhận được.
+    on_complete(wav_bytes): gọi với WAV hoàn chỉnh khi stream xong (để cache)
+    """
+    yield STREAMING_WAV_HEADER
+    
+    parts = []
+    for resampled in resample_stream(pcm_chunks):
+        parts.append(resampled)
+        yield resampled
+    
+    resampled_pcm = b''.join(parts)
+    logger.info(f"✓ Streamed {len(resampled_pcm)} bytes of 16kHz audio")
+    if on_complete:
+        on_complete(create_wav_header(len(resampled_pcm), 16000, 1, 16) + resampled_pcm)
+
+
+# Audio đã tạo theo (text, format, voice) cho các câu trả lời lặp lại
+tts_cache = TTLCache(maxsize=TTS_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL)
+
+
 def text_to_speech(text, format='mp3', language='auto', session_id=None):
     """Convert text to speech with automatic voice selection"""
     try:
-        if session_id and CONTEXT_ENABLED:
-            voice = ConversationManager.get_voice(session_id)
-            logger.info(f"🎤 Using session voice preference: {voice}")
-        else:
-            if language == 'auto':
-                detected_lang = detect_language(text)
-                voice = VOICE_MAP.get(detected_lang, OPENAI_VOICE)
-            else:
-                voice = VOICE_MAP.get(language, OPENAI_VOICE)
+        voice = select_voice(text, language, session_id)
+        
+        cache_key = (text, format, voice)
+        cached_audio = tts_cache.get(cache_key)
+        if cached_audio:
+            logger.info(f"♻️ TTS cache hit ({format}, voice={voice})")
+            return cached_audio
         
         logger.info(f"🔊 Converting to speech ({format}, voice={voice}, lang={language}): {text[:50]}...")
         
         if format == 'wav':
-            response = client.audio.speech.create(
-                model="tts-1",
-                voice=voice,
-                input=text,
-                response_format="pcm"
-            )
-            
-            pcm_data = response.content
-            logger.info(f"✓ Received {len(pcm_data)} bytes of PCM audio")
-            
-            pcm_16bit = struct.unpack(f'<{len(pcm_data)//2}h', pcm_data)
-            resampled = []
-            position = 0.0
-            step = 24000 / 16000
-            
-            while int(position) < len(pcm_16bit):
-                resampled.append(pcm_16bit[int(position)])
-                position += step
-            
-            resampled_pcm = struct.pack(f'<{len(resampled)}h', *resampled)
-            logger.info(f"✓ Resampled to {len(resampled_pcm)} bytes at 16kHz")
-            
-            wav_header = create_wav_header(len(resampled_pcm), 16000, 1, 16)
-            wav_file = wav_header + resampled_pcm
+            wav_file = pcm_to_wav(synthesize_pcm(text, voice))
+            tts_cache.set(cache_key, wav_file)
             
             logger.info(f"✓ Generated {len(wav_file)} bytes of WAV audio (voice: {voice})")
             return wav_file
             
         else:
-            response = client.audio.speech.create(
-                model="tts-1",
-                voice=voice,
-                input=text,
-                response_format="mp3"
-            )
+            # Đọc MP3 theo chunk từ streaming response, không qua file tạm
+            chunks, close_stream = open_speech_stream(text, voice)
+            try:
+                audio_bytes = b''.join(chunks)
+            finally:
+                close_stream()
+            tts_cache.set(cache_key, audio_bytes)
             
-            audio_bytes = response.content
             logger.info(f"✓ Generated {len(audio_bytes)} bytes of MP3 audio (voice: {voice})")
             return audio_bytes
         
@@ -608,15 +1360,190 @@ def text_to_speech(text, format='mp3', language='auto', session_id=None):
         raise
 
 
-def create_wav_header(data_size, sample_rate=16000, channels=1, bits_per_sample=16):
-    """Create a WAV file header"""
+def open_speech_stream(text, voice, response_format='mp3'):
+    """
+    Mở streaming TTS ngay (lỗi API xảy ra trước khi gửi header cho client).
+    Returns: (chunks, close) — chunks là iterator bytes, close() đóng kết nối OpenAI
+    """
+    stream = client.audio.speech.with_streaming_response.create(
+        model="tts-1",
+        voice=voice,
+        input=text,
+        response_format=response_format
+    )
+    response = stream.__enter__()
+    return response.iter_bytes(chunk_size=4096), lambda: stream.__exit__(None, None, None)
+
+
+@lru_cache(maxsize=64)
+def canned_speech_wav(text, voice):
+    """WAV cho câu cố định (greeting, xác nhận lệnh...): gọi TTS lần đầu, sau đó lấy từ cache"""
+    logger.info(f"🔊 Caching canned speech (voice={voice}): {text[:50]}...")
+    return pcm_to_wav(synthesize_pcm(text, voice))
+
+
+def looks_like_command_json(text):
+    """
+    Kiểm tra rẻ câu trả lời có dạng {...} (lệnh điều khiển) trước khi parse JSON.
+    Câu trả lời thường không bắt đầu bằng khoảng trắng/'{' nên dừng ngay ở ký tự đầu.
+    """
+    return (
+        bool(text)
+        and text[0] in '{ \t\r\n'
+        and text.lstrip().startswith('{')
+        and text.rstrip().endswith('}')
+    )
+
+
+# Content-Type của upload chứa PCM 16-bit thô (không có WAV header)
+RAW_PCM_MIMETYPES = ('audio/pcm', 'audio/l16')
+
+# Tên file cho Whisper khi upload không có filename (Whisper nhận diện định dạng theo đuôi file)
+COMPRESSED_AUDIO_FILENAMES = {
+    'audio/ogg': 'audio.ogg',
+    'audio/opus': 'audio.opus',
+    'audio/webm': 'audio.webm',
+    'audio/flac': 'audio.flac',
+    'audio/x-flac': 'audio.flac',
+    'audio/mpeg': 'audio.mp3',
+}
+
+# Thread pool cho TTS từng câu (chạy song song với phần chat còn đang stream)
+tts_pool = ThreadPoolExecutor(max_workers=TTS_WORKERS, thread_name_prefix="tts")
+
+
+def warm_canned_speech():
+    """Đưa TTS các câu cố định (theo voice mặc định của từng ngôn ngữ) vào cache lúc khởi động"""
+    for lang in ('vi', 'en'):
+        texts = (
+            GREETINGS[lang],
+            INAPPROPRIATE_RESPONSES[lang],
+            *(confirmations[lang] for confirmations in COMMAND_CONFIRMATIONS.values())
+        )
+        for text in texts:
+            tts_pool.submit(canned_speech_wav, text, VOICE_MAP[lang])
+
+
+if client and TTS_WARMUP:
+    warm_canned_speech()
+
+# Ranh giới câu: dấu kết thúc câu theo sau là khoảng trắng
+SENTENCE_END_RE = re.compile(r'[.!?…。！？]+\s+')
+
+
+def speak_while_streaming(reply_chunks, voice):
+    """
+    Đọc câu trả lời đang stream, gửi TTS (PCM) cho từng đoạn câu hoàn chỉnh
+    ngay khi có, song song với phần chat còn lại.
+    Returns: (full_text, tts_futures) — tts_futures là None nếu câu trả lời là lệnh JSON
+    """
+    parts = []
+    buffer = ''
+    tts_futures = []
+    is_command = None
+    
+    for delta in reply_chunks:
+        parts.append(delta)
+        if is_command is None:
+            head = ''.join(parts).lstrip()
+            if head:
+                is_command = head.startswith('{')
+        if is_command:
+            continue
+        
+        buffer += delta
+        boundary = 0
+        for match in SENTENCE_END_RE.finditer(buffer):
+            boundary = match.end()
+        if boundary >= TTS_MIN_SENTENCE_CHARS:
+            tts_futures.append(tts_pool.submit(synthesize_pcm, buffer[:boundary].strip(), voice))
+            buffer = buffer[boundary:]
+    
+    full_text = ''.join(parts)
+    if is_command:
+        return full_text, None
+    
+    if buffer.strip():
+        tts_futures.append(tts_pool.submit(synthesize_pcm, buffer.strip(), voice))
+    
+    logger.info(f"🔀 Pipelined TTS in {len(tts_futures)} chunk(s) (voice: {voice})")
+    return full_text, tts_futures
+
+
+# Cache (raw_ai_response, wav_bytes) cho /api/voice-chat
+response_cache = TTLCache(maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL)
+
+
+def normalize_prompt(text):
+    """Chuẩn hoá câu hỏi làm key cache: chữ thường, gộp khoảng trắng"""
+    return ' '.join(text.lower().split())
+
+
+# Cache text câu trả lời của chat: câu hỏi lặp lại (xin chào, hello...) không cần gọi OpenAI
+reply_cache = TTLCache(maxsize=REPLY_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL)
+
+
+def reply_cache_key(user_message, language):
+    """
+    Key reply_cache: (model, ngôn ngữ, câu hỏi chuẩn hoá). Chỉ gọi sau khi đã lọc nội dung
+    và xử lý lệnh đổi giọng / đổi ngôn ngữ, và chỉ cho lượt không phụ thuộc lịch sử
+    (không có context, hoặc lượt đầu của session); None nếu cache tắt hoặc câu hỏi rỗng.
+    """
+    if REPLY_CACHE_SIZE <= 0:
+        return None
+    normalized = normalize_prompt(user_message)
+    return (OPENAI_MODEL, language, normalized) if normalized else None
+
+
+def response_cache_key(transcribed_text, session_id):
+    """
+    Key cache cho câu hỏi đã transcribe: (model, voice, language, text chuẩn hoá).
+    Trả về None nếu câu này không được cache (greeting, không an toàn,
+    đổi giọng / đổi ngôn ngữ) vì khi đó get_chat_response còn thay đổi session,
+    và khi session đã có lịch sử: câu trả lời khi đó phụ thuộc context của riêng session.
+    """
+    if RESPONSE_CACHE_SIZE <= 0:
+        return None
+    # Kiểm tra trước classify() và các regex intent: session đã có lịch sử thì không bao giờ cache
+    if CONTEXT_ENABLED and ConversationManager.get_context_length(session_id) > 1:
+        return None
+    
+    normalized = normalize_prompt(transcribed_text)
+    if not normalized:
+        return None
+    
+    detected_lang, is_safe = classify(normalized)
+    if not is_safe:
+        return None
+    if detect_voice_change_intent(normalized)[1] or detect_language_switch_intent(normalized)[1]:
+        return None
+    
+    if CONTEXT_ENABLED:
+        language = ConversationManager.get_language(session_id)
+        # Tự chuyển ngôn ngữ theo input → không dùng cache
+        if detected_lang not in ('auto', language):
+            return None
+        voice = ConversationManager.get_voice(session_id)
+    else:
+        language, voice = BOT_LANGUAGE, OPENAI_VOICE
+    
+    return (OPENAI_MODEL, voice, language, normalized)
+
+
+# RIFF/WAVE header 44 bytes (PCM), compile format một lần
+WAV_HEADER_STRUCT = struct.Struct('<4sI4s4sIHHIIHH4sI')
+WAV_SIZE_FIELD = struct.Struct('<I')
+
+
+@lru_cache(maxsize=8)
+def wav_header_template(sample_rate, channels, bits_per_sample):
+    """Header cố định cho một định dạng, các trường kích thước để 0"""
     byte_rate = sample_rate * channels * bits_per_sample // 8
     block_align = channels * bits_per_sample // 8
     
-    header = struct.pack(
-        '<4sI4s4sIHHIIHH4sI',
+    return WAV_HEADER_STRUCT.pack(
         b'RIFF',
-        data_size + 36,
+        36,
         b'WAVE',
         b'fmt ',
         16,
@@ -627,9 +1554,20 @@ def create_wav_header(data_size, sample_rate=16000, channels=1, bits_per_sample=
         block_align,
         bits_per_sample,
         b'data',
-        data_size
+        0
     )
-    return header
+
+
+def create_wav_header(data_size, sample_rate=16000, channels=1, bits_per_sample=16):
+    """Create a WAV file header (copy template, chỉ ghi lại 2 trường kích thước)"""
+    header = bytearray(wav_header_template(sample_rate, channels, bits_per_sample))
+    WAV_SIZE_FIELD.pack_into(header, 4, data_size + 36)
+    WAV_SIZE_FIELD.pack_into(header, 40, data_size)
+    return bytes(header)
+
+
+# Header cho WAV stream: chưa biết độ dài nên các trường kích thước để tối đa
+STREAMING_WAV_HEADER = create_wav_header(0xFFFFFFFF - 36)
 
 
 # ============================================
@@ -652,41 +1590,71 @@ def chat():
         data = request.json
         user_message = data.get('message', '')
         session_id = data.get('session_id') or request.headers.get('X-Session-ID')
+        stream = bool(data.get('stream')) or 'text/event-stream' in request.headers.get('Accept', '')
         
         if not user_message:
             return jsonify({'error': 'Message is required'}), 400
         
-        ConversationManager.cleanup_old_sessions()
-        
+        # Không bật context: không tạo session (tránh mỗi request để lại một session trong bộ nhớ)
         if CONTEXT_ENABLED:
             session_id = ConversationManager.get_or_create_session(session_id)
-        else:
-            session_id = ConversationManager.get_or_create_session()
         
-        detected_lang = detect_language(user_message)
+        detected_lang, is_safe = classify(user_message)
         logger.info(f"Detected language: {detected_lang} for message: {user_message[:50]}")
         
-        if not is_safe_content(user_message):
-            response_text = get_response_template('inappropriate', detected_lang)
+        if not is_safe:
+            response_text = INAPPROPRIATE_RESPONSES[detected_lang]
             if CONTEXT_ENABLED:
                 ConversationManager.add_message(session_id, "user", user_message)
                 ConversationManager.add_message(session_id, "assistant", response_text)
             return jsonify({'response': response_text, 'session_id': session_id})
         
-        assistant_message = get_chat_response(user_message, session_id)
+        if stream:
+            return stream_chat(user_message, session_id, detected_lang)
+        
+        assistant_message = get_chat_response(user_message, session_id, classification=(detected_lang, is_safe))
         
         return jsonify({
             'response': assistant_message,
             'model': OPENAI_MODEL,
             'detected_language': detected_lang,
             'session_id': session_id,
-            'context_length': len(ConversationManager.get_messages(session_id)) if CONTEXT_ENABLED else 0
+            'context_length': ConversationManager.get_context_length(session_id) if CONTEXT_ENABLED else 0
         })
     
     except Exception as e:
         logger.error(f"Error in chat endpoint: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+def stream_chat(user_message, session_id, detected_lang):
+    """Trả lời /api/chat dạng text/event-stream: các event 'delta' rồi một event 'done'"""
+    reply = get_chat_response(user_message, session_id, stream=True, classification=(detected_lang, True))
+    
+    def generate():
+        try:
+            if isinstance(reply, str):
+                yield sse_event({'delta': reply})
+            else:
+                for text in reply:
+                    yield sse_event({'delta': text})
+            yield sse_event({
+                'done': True,
+                'model': OPENAI_MODEL,
+                'detected_language': detected_lang,
+                'session_id': session_id,
+                'context_length': ConversationManager.get_context_length(session_id) if CONTEXT_ENABLED else 0
+            })
+        except Exception as e:
+            logger.error(f"Error streaming chat response: {str(e)}")
+            yield sse_event({'error': str(e), 'session_id': session_id})
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
 @app.route('/api/transcribe', methods=['POST'])
 def transcribe():
     """Handle audio transcription requests"""
@@ -699,19 +1667,15 @@ def transcribe():
         
         audio_file = request.files['audio']
         
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.webm') as temp_audio:
-            audio_file.save(temp_audio.name)
-            
-            with open(temp_audio.name, 'rb') as audio_data:
-                transcript = client.audio.transcriptions.create(
-                    model="whisper-1",
-                    file=audio_data,
-                )
-            
-            os.unlink(temp_audio.name)
-            logger.info(f"Transcribed text: {transcript.text}")
-            
-            return jsonify({'text': transcript.text})
+        # Gửi thẳng stream của upload cho Whisper (không copy sang buffer khác, không ghi file tạm)
+        transcript = client.audio.transcriptions.create(
+            model="whisper-1",
+            file=(audio_file.filename or 'audio.webm', audio_file.stream, audio_file.mimetype),
+        )
+        
+        logger.info(f"Transcribed text: {transcript.text}")
+        
+        return jsonify({'text': transcript.text})
     
     except Exception as e:
         logger.error(f"Error in transcribe endpoint: {str(e)}")
@@ -732,15 +1696,23 @@ def voice():
         if not text:
             return jsonify({'error': 'Text is required'}), 400
         
-        # Generate speech với voice tự động chọn
-        audio_bytes = text_to_speech(text, format='mp3', language=language)
-        
-        # Save to temp file
-        output_path = Path("/tmp/speech.mp3")
-        with open(output_path, 'wb') as f:
-            f.write(audio_bytes)
+        if data.get('stream'):
+            # Client chọn stream: relay MP3 theo chunk ngay khi OpenAI trả về (không có Content-Length)
+            voice = select_voice(text, language)
+            logger.info(f"🔊 Streaming speech (mp3, voice={voice}, lang={language}): {text[:50]}...")
+            chunks, close_stream = open_speech_stream(text, voice)
+            
+            response = Response(chunks, mimetype='audio/mpeg')
+            response.call_on_close(close_stream)
+            return response
         
-        return send_from_directory('/tmp', 'speech.mp3', mimetype='audio/mpeg')
+        # Mặc định trả nguyên khối kèm Content-Length (ESP32 tải vào buffer cố định)
+        audio_bytes = text_to_speech(text, format='mp3', language=language)
+        return Response(
+            audio_bytes,
+            mimetype='audio/mpeg',
+            headers={'Content-Length': str(len(audio_bytes))}
+        )
     
     except Exception as e:
         logger.error(f"Error in voice endpoint: {str(e)}")
@@ -755,40 +1727,98 @@ def voice_chat():
     try:
         session_id = request.headers.get('X-Session-ID')
         if not session_id:
-            session_id = secrets.token_hex(16)
+            session_id = secrets.token_urlsafe(12)
             logger.info(f"🆕 Created new session for ESP32: {session_id}")
         
-        if 'audio' not in request.files:
+        if 'audio' in request.files:
+            upload = request.files['audio']
+            stream, filename, mimetype = upload.stream, upload.filename, upload.mimetype
+        elif request.mimetype.startswith('audio/'):
+            # Body là audio trực tiếp (vd: Content-Type: audio/ogg; codecs=opus)
+            stream, filename, mimetype = request.stream, None, request.mimetype
+        else:
             return jsonify({'error': 'No audio file provided'}), 400
         
-        audio_data = request.files['audio'].read()
-        logger.info(f"📥 Received {len(audio_data)} bytes of audio (session: {session_id})")
-
-        transcribed_text = transcribe_audio(audio_data)
+        if mimetype in RAW_PCM_MIMETYPES:
+            # PCM thô: chép thẳng từ stream vào buffer có WAV header trước khi gửi Whisper
+            sample_rate = int(request.form.get('sample_rate') or request.headers.get('X-Sample-Rate') or 16000)
+            channels = int(request.form.get('channels') or request.headers.get('X-Channels') or 1)
+            audio_data = read_raw_pcm(stream, sample_rate, channels)
+            audio_view = audio_data.getbuffer()
+            filename, mimetype = 'audio.wav', 'audio/wav'
+        else:
+            audio_data = stream.read()
+            audio_view = memoryview(audio_data)
+        logger.info(f"📥 Received {audio_view.nbytes} bytes of {mimetype} audio (session: {session_id})")
+        
+        # Bấm nút nhưng không nói gì → trả về ngay, không tốn một lần gọi Whisper
+        rms = wav_rms(audio_view) if SILENCE_RMS_THRESHOLD > 0 and audio_view[:4] == b'RIFF' else None
+        audio_view.release()
+        if rms is not None and rms < SILENCE_RMS_THRESHOLD:
+            logger.info(f"🔇 Silent audio (RMS {rms:.1f}), skipping Whisper (session: {session_id})")
+            return jsonify({'success': False, 'error': 'silence', 'session_id': session_id}), 200, {'X-Session-ID': session_id}
+        
+        # Opus/FLAC/WAV... gửi thẳng cho Whisper, giữ tên file và Content-Type gốc
+        transcribed_text = transcribe_audio(
+            audio_data,
+            filename or COMPRESSED_AUDIO_FILENAMES.get(mimetype, 'audio.wav'),
+            mimetype if mimetype.startswith('audio/') else 'audio/wav'
+        )
         logger.info(f"📝 Transcribed: {transcribed_text}")
 
         # Kiểm tra nếu là lần đầu tiên gọi → trả greeting
-        messages = ConversationManager.get_messages(session_id) if session_id in conversations else []
-        is_first_message = len(messages) <= 1  # Chỉ có system prompt
+        is_first_message = ConversationManager.get_context_length(session_id) <= 1  # Chỉ có system prompt
+        
+        # Lần đầu có context → greeting, không cache (không context thì mọi lượt đều như lượt đầu)
+        cache_key = None if CONTEXT_ENABLED and is_first_message else response_cache_key(transcribed_text, session_id)
+        cached = response_cache.get(cache_key) if cache_key else None
         
-        raw_ai_response = get_chat_response(transcribed_text, session_id, return_greeting=is_first_message)
+        if cached:
+            # Cache hit: bỏ qua Chat và TTS, vẫn ghi vào lịch sử hội thoại
+            raw_ai_response, cached_audio = cached
+            tts_futures = None
+            logger.info(f"♻️ Response cache hit (session: {session_id})")
+            if CONTEXT_ENABLED:
+                ConversationManager.add_message(session_id, "user", transcribed_text)
+                ConversationManager.add_message(session_id, "assistant", raw_ai_response)
+        else:
+            cached_audio = None
+            # Với context, voice đã biết trước → stream chat và TTS từng câu song song
+            reply = get_chat_response(
+                transcribed_text, session_id, return_greeting=is_first_message, stream=CONTEXT_ENABLED
+            )
+            if isinstance(reply, str):
+                raw_ai_response, tts_futures = reply, None
+            else:
+                raw_ai_response, tts_futures = speak_while_streaming(reply, ConversationManager.get_voice(session_id))
         logger.info(f"🤖 Raw AI Response: {raw_ai_response}")
 
         current_lang = ConversationManager.get_language(session_id) if CONTEXT_ENABLED else detect_language(raw_ai_response)
 
+        # Client mới gửi "X-Header-Encoding: base64"; firmware cũ vẫn nhận UTF-8 qua latin-1 như trước
+        if request.headers.get('X-Header-Encoding', '').lower() == 'base64':
+            text_headers = {
+                'X-Transcription-B64': encode_header_text_b64(transcribed_text),
+                'X-Response-Text-B64': encode_header_text_b64(raw_ai_response)
+            }
+        else:
+            text_headers = {
+                'X-Transcription': encode_header_text(transcribed_text),
+                'X-Response-Text': HEADER_TEXTS.get(raw_ai_response) or encode_header_text(raw_ai_response)
+            }
+        
         response_headers = {
             'Content-Type': 'audio/wav',
-            'X-Transcription': transcribed_text.encode('utf-8').decode('latin-1'),
-            'X-Response-Text': raw_ai_response.encode('utf-8').decode('latin-1'),
+            **text_headers,
             'X-Session-ID': session_id,
             'X-Language': current_lang
         }
         
         text_for_tts = raw_ai_response
 
-        if raw_ai_response.strip().startswith('{'):
+        if looks_like_command_json(raw_ai_response):
             try:
-                command_data = json.loads(raw_ai_response)
+                command_data = app.json.loads(raw_ai_response)
                 command = command_data.get("command")
                 value = command_data.get("value")
 
@@ -796,36 +1826,57 @@ def voice_chat():
                     logger.info(f"✅ Parsed command: {command}, value: {value}")
                     response_headers['X-Device-Command'] = command
                     response_headers['X-Device-Value'] = str(value)
-                    
-                    confirmations = {
-                        'set_volume': {
-                            'vi': 'Đã điều chỉnh âm lượng',
-                            'en': 'Volume adjusted'
-                        },
-                        'set_mic_gain': {
-                            'vi': 'Đã chỉnh độ nhạy mic',
-                            'en': 'Mic sensitivity adjusted'
-                        },
-                        'stop_conversation': {
-                            'vi': 'Tạm biệt',
-                            'en': 'Goodbye'
-                        }
-                    }
-                    text_for_tts = confirmations.get(command, {}).get(current_lang, raw_ai_response)
+                    text_for_tts = COMMAND_CONFIRMATIONS.get(command, {}).get(current_lang, raw_ai_response)
             except json.JSONDecodeError:
                 logger.warning("Response looked like JSON but was not valid.")
 
-        audio_response = text_to_speech(text_for_tts, format='wav', language=current_lang, session_id=session_id)
+        # WAV có sẵn (cache / câu cố định) trả về nguyên khối, còn lại stream PCM → WAV theo chunk
+        audio_response = pcm_chunks = close_stream = tts_cache_key = None
+        if cached_audio:
+            audio_response = cached_audio
+        elif tts_futures:
+            # Chờ đoạn đầu trước khi gửi header: lỗi TTS vẫn trả về 500 thay vì WAV bị cụt
+            tts_futures[0].result()
+            pcm_chunks = (future.result() for future in tts_futures)
+        elif text_for_tts in CANNED_TTS_TEXTS:
+            audio_response = canned_speech_wav(text_for_tts, select_voice(text_for_tts, current_lang, session_id))
+        else:
+            voice = select_voice(text_for_tts, current_lang, session_id)
+            tts_cache_key = (text_for_tts, 'wav', voice)
+            audio_response = tts_cache.get(tts_cache_key)
+            if not audio_response:
+                pcm_chunks, close_stream = open_speech_stream(text_for_tts, voice, response_format='pcm')
+        
         logger.info(f"🔊 Generated TTS: '{text_for_tts}' (lang={current_lang}, session={session_id})")
         
-        return Response(
-            audio_response,
+        if audio_response:
+            if cache_key and not cached:
+                response_cache.set(cache_key, (raw_ai_response, audio_response))
+            return Response(
+                audio_response,
+                mimetype='audio/wav',
+                headers=response_headers
+            )
+        
+        def cache_audio(wav_file):
+            if tts_cache_key:
+                tts_cache.set(tts_cache_key, wav_file)
+            if cache_key:
+                response_cache.set(cache_key, (raw_ai_response, wav_file))
+        
+        # Header gửi ngay, ESP32 phát được đoạn đầu trong khi TTS còn đang tạo
+        response = Response(
+            stream_pcm_as_wav(pcm_chunks, on_complete=cache_audio),
             mimetype='audio/wav',
-            headers=response_headers
+            headers=response_headers,
+            direct_passthrough=True
         )
+        if close_stream:
+            response.call_on_close(close_stream)
+        return response
 
     except Exception as e:
-        logger.error(f"❌ Error in voice_chat: {str(e)}", exc_info=True)
+        logger.exception(f"❌ Error in voice_chat: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
 
@@ -849,25 +1900,167 @@ def clear_context():
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/api/context/stats', methods=['GET'])
+def context_stats():
+    """Thống kê tổng hợp các session đang hoạt động (không liệt kê session ID)"""
+    try:
+        # Chỉ trả số liệu tổng hợp: session ID là thứ duy nhất bảo vệ hội thoại của trẻ,
+        # lộ ra thì ai gọi được port này cũng đọc được lịch sử qua /api/chat
+        # message_count được tính sẵn khi tạo/cập nhật session
+        sessions = list(conversations.values())
+        
+        stats = {
+            'active_sessions': len(sessions),
+            'total_messages': sum(data['message_count'] for data in sessions),
+            'context_tokens': sum(data['total_tokens'] for data in sessions),
+            'context_max_messages': CONTEXT_MAX_MESSAGES,
+            'context_max_tokens': CONTEXT_MAX_TOKENS,
+            'context_timeout_minutes': CONTEXT_TIMEOUT_MINUTES
+        }
+        
+        if CONTEXT_PERSIST and db:
+            stats['database'] = db.get_session_stats()
+        
+        return jsonify(stats)
+    
+    except Exception as e:
+        logger.error(f"Error in context_stats: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/chat/batch', methods=['POST'])
+def create_chat_batch():
+    """
+    Gửi nhiều câu hỏi qua OpenAI Batch API (xử lý offline, rẻ hơn, không ảnh hưởng
+    rate limit của /api/voice-chat). Body: {"items": [{"message", "language"?, "custom_id"?}]}
+    """
+    if not BATCH_API_ENABLED:
+        return jsonify({'error': 'Batch API disabled (BATCH_API_ENABLED=false)'}), 404
+    if not client:
+        return jsonify({'error': 'OpenAI API key not configured'}), 500
+    
+    try:
+        data = request.get_json(silent=True)
+        items = data.get('items') if isinstance(data, dict) else None
+        if not isinstance(items, list) or not items:
+            return jsonify({'error': 'items must be a non-empty list'}), 400
+        if len(items) > BATCH_MAX_ITEMS:
+            return jsonify({'error': f'Too many items (max {BATCH_MAX_ITEMS})'}), 400
+        
+        lines = []
+        custom_ids = set()
+        for index, item in enumerate(items):
+            if not isinstance(item, dict):
+                return jsonify({'error': f'items[{index}] must be an object'}), 400
+            message = item.get('message')
+            if not message or not isinstance(message, str):
+                return jsonify({'error': f'items[{index}].message is required'}), 400
+            # custom_id phải duy nhất trong batch, không thì OpenAI từ chối cả batch sau khi đã upload file
+            custom_id = str(item.get('custom_id') or f'item-{index}')
+            if custom_id in custom_ids:
+                return jsonify({'error': f'Duplicate custom_id: {custom_id}'}), 400
+            custom_ids.add(custom_id)
+            
+            lines.append(app.json.dumps({
+                'custom_id': custom_id,
+                'method': 'POST',
+                'url': '/v1/chat/completions',
+                'body': {
+                    'model': OPENAI_MODEL,
+                    'messages': [
+                        {'role': 'system', 'content': get_system_prompt(item.get('language') or BOT_LANGUAGE)},
+                        {'role': 'user', 'content': message}
+                    ],
+                    'max_tokens': MAX_TOKENS,
+                    'temperature': TEMPERATURE
+                }
+            }))
+        
+        input_file = client.files.create(
+            file=('batch.jsonl', '\n'.join(lines).encode('utf-8')),
+            purpose='batch'
+        )
+        batch = client.batches.create(
+            input_file_id=input_file.id,
+            endpoint='/v1/chat/completions',
+            completion_window='24h'
+        )
+        logger.info(f"📦 Created chat batch {batch.id} with {len(lines)} request(s)")
+        
+        return jsonify({'batch_id': batch.id, 'status': batch.status, 'count': len(lines)}), 202
+    
+    except Exception as e:
+        logger.error(f"Error in create_chat_batch: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/chat/batch/<batch_id>', methods=['GET'])
+def get_chat_batch(batch_id):
+    """Trạng thái batch; khi hoàn tất trả về câu trả lời (và lỗi) theo custom_id"""
+    if not BATCH_API_ENABLED:
+        return jsonify({'error': 'Batch API disabled (BATCH_API_ENABLED=false)'}), 404
+    if not client:
+        return jsonify({'error': 'OpenAI API key not configured'}), 500
+    
+    try:
+        batch = client.batches.retrieve(batch_id)
+        result = {'batch_id': batch.id, 'status': batch.status}
+        
+        if batch.status == 'completed':
+            responses = {}
+            errors = {}
+            # Request lỗi nằm trong error_file_id (hoặc trong output với status_code != 200)
+            for file_id in (batch.output_file_id, getattr(batch, 'error_file_id', None)):
+                if not file_id:
+                    continue
+                for line in client.files.content(file_id).text.splitlines():
+                    if not line.strip():
+                        continue
+                    entry = app.json.loads(line)
+                    response = entry.get('response') or {}
+                    body = response.get('body') or {}
+                    choices = body.get('choices') or []
+                    if entry.get('error') or response.get('status_code', 200) != 200 or not choices:
+                        error = entry.get('error') or body.get('error') or {}
+                        errors[entry['custom_id']] = error.get('message') or f"status {response.get('status_code')}"
+                    else:
+                        responses[entry['custom_id']] = choices[0]['message']['content']
+            result['responses'] = responses
+            result['errors'] = errors
+        
+        return jsonify(result)
+    
+    except Exception as e:
+        logger.error(f"Error in get_chat_batch: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+
+# Phần cố định của /api/health được encode sẵn (bỏ dấu '}' cuối để nối active_sessions)
+HEALTH_JSON_PREFIX = app.json.dumps({
+    'status': 'ok',
+    'model': OPENAI_MODEL,
+    'voice': OPENAI_VOICE,
+    'language': BOT_LANGUAGE,
+    'api_key_configured': bool(OPENAI_API_KEY),
+    'context_enabled': CONTEXT_ENABLED,
+    'context_persist': CONTEXT_PERSIST
+})[:-1]
+
+
 @app.route('/api/health', methods=['GET'])
 def health():
     """Health check endpoint"""
-    return jsonify({
-        'status': 'ok',
-        'model': OPENAI_MODEL,
-        'voice': OPENAI_VOICE,
-        'language': BOT_LANGUAGE,
-        'api_key_configured': bool(OPENAI_API_KEY),
-        'context_enabled': CONTEXT_ENABLED,
-        'context_persist': CONTEXT_PERSIST,
-        'active_sessions': len(conversations)
-    })
+    return Response(
+        f'{HEALTH_JSON_PREFIX},"active_sessions":{len(conversations)}}}',
+        mimetype='application/json',
+        headers={'Cache-Control': 'max-age=5'}
+    )
 
 @app.route('/debug/audio/<filename>')
 def serve_debug_audio(filename):
     """Serve debug audio files for quality checking"""
     try:
-        debug_dir = os.path.abspath("debug_audio")
+        debug_dir = DEBUG_AUDIO_DIR
         
         if '..' in filename or '/' in filename:
             return jsonify({'error': 'Invalid filename'}), 400
@@ -877,35 +2070,30 @@ def serve_debug_audio(filename):
         if not os.path.exists(file_path):
             return jsonify({'error': 'File not found'}), 404
         
-        return send_from_directory(debug_dir, filename)
+        if AUDIO_ACCEL_REDIRECT_PREFIX:
+            # nginx tự sendfile(2) file, Python chỉ trả header
+            response = make_response('')
+            response.headers['X-Accel-Redirect'] = f"{AUDIO_ACCEL_REDIRECT_PREFIX.rstrip('/')}/{filename}"
+            response.headers['Content-Type'] = 'audio/mpeg' if filename.endswith('.mp3') else 'audio/wav'
+            response.headers['Cache-Control'] = 'public, max-age=3600'
+            return response
+        
+        if USE_X_SENDFILE:
+            # Chỉ route tải file dùng X-Sendfile; trang index / danh sách vẫn do Flask trả như thường
+            response = make_response('')
+            response.headers['X-Sendfile'] = file_path
+            response.headers['Content-Type'] = 'audio/mpeg' if filename.endswith('.mp3') else 'audio/wav'
+            response.headers['Cache-Control'] = 'public, max-age=3600'
+            return response
+        
+        return send_from_directory(debug_dir, filename, max_age=3600)
         
     except Exception as e:
         logger.error(f"Error serving debug audio: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
-@app.route('/debug/audio')
-def list_debug_audio():
-    """List all debug audio files with playable links"""
-    try:
-        debug_dir = "debug_audio"
-        
-        if not os.path.exists(debug_dir):
-            return jsonify({'message': 'No debug files yet', 'files': []})
-        
-        files = []
-        for filename in sorted(os.listdir(debug_dir), reverse=True):
-            if filename.endswith('.wav') or filename.endswith('.mp3'):
-                file_path = os.path.join(debug_dir, filename)
-                stat = os.stat(file_path)
-                
-                files.append({
-                    'filename': filename,
-                    'size': stat.st_size,
-                    'created': datetime.fromtimestamp(stat.st_ctime).isoformat(),
-                    'url': f"{SERVER_URL}/debug/audio/{filename}"
-                })
-        
-        html = """
+# Template trang /debug/audio: compile một lần lúc import, Jinja tự escape (from_string → autoescape)
+DEBUG_AUDIO_TEMPLATE = app.jinja_env.from_string("""
         <!DOCTYPE html>
         <html>
         <head>
@@ -927,36 +2115,62 @@ def list_debug_audio():
         </head>
         <body>
             <h1>🎧 Debug Audio Files</h1>
-            <p>Total files: """ + str(len(files)) + """</p>
-        """
-        
-        if files:
-            for file in files:
-                html += f"""
+            <p>Total files: {{ files|length }}</p>
+        {% for file in files %}
                 <div class="file">
-                    <h3>{file['filename']}</h3>
-                    <div class="info">Size: {file['size']:,} bytes</div>
-                    <div class="info">Created: {file['created']}</div>
+                    <h3>{{ file.filename }}</h3>
+                    <div class="info">Size: {{ '{:,}'.format(file.size) }} bytes</div>
+                    <div class="info">Created: {{ file.created }}</div>
                     <audio controls preload="metadata">
-                        <source src="{file['url']}" type="audio/wav">
+                        <source src="{{ file.url }}" type="audio/wav">
                         Your browser does not support audio playback.
                     </audio>
-                    <a href="{file['url']}" download>⬇️ Download</a>
+                    <a href="{{ file.url }}" download>⬇️ Download</a>
                 </div>
-                """
-        else:
-            html += '<div class="no-files">No audio files yet. Make a recording first!</div>'
-        
-        html += """
+        {% else %}
+            <div class="no-files">No audio files yet. Make a recording first!</div>
+        {% endfor %}
         </body>
         </html>
-        """
+        """)
+
+
+@app.route('/debug/audio')
+def list_debug_audio():
+    """List all debug audio files with playable links"""
+    try:
+        debug_dir = DEBUG_AUDIO_DIR
+        
+        if not os.path.exists(debug_dir):
+            return jsonify({'message': 'No debug files yet', 'files': []})
+        
+        files = []
+        # scandir: stat lấy từ DirEntry, không cần join path + os.stat riêng
+        with os.scandir(debug_dir) as it:
+            entries = sorted(
+                (entry for entry in it if entry.name.endswith(('.wav', '.mp3'))),
+                key=lambda entry: entry.name,
+                reverse=True
+            )
+        for entry in entries:
+            try:
+                stat = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue  # bị audio-janitor xoá giữa chừng
+            
+            files.append({
+                'filename': entry.name,
+                'size': stat.st_size,
+                'created': datetime.fromtimestamp(stat.st_ctime).isoformat(),
+                'url': DEBUG_AUDIO_URL_BASE + entry.name
+            })
         
-        return html
+        return DEBUG_AUDIO_TEMPLATE.render(files=files)
         
     except Exception as e:
         logger.error(f"Error listing debug audio: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=PORT, debug=(LOG_LEVEL == 'DEBUG'))
+    # Chỉ dùng khi chạy local; production chạy qua gunicorn (gunicorn.conf.py)
+    app.run(host='0.0.0.0', port=PORT, debug=(LOG_LEVEL == 'DEBUG'), threaded=True)
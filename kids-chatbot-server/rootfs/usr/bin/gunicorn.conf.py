@@ -0,0 +1,33 @@
+# rootfs/usr/bin/gunicorn.conf.py
+# Gunicorn config cho Kids ChatBot Server
+#
+# Mỗi request chủ yếu chờ OpenAI (network I/O, nhả GIL) nên dùng gthread:
+# nhiều thread trong một worker phục vụ song song các request.
+
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+
+# gthread mặc định; có thể đổi sang 'gevent' (cần pip install gevent, gunicorn tự
+# monkey-patch khi worker khởi động) để mỗi request chờ OpenAI chỉ chiếm một greenlet
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', '200'))
+# Session (context) nằm trong bộ nhớ của từng process → mặc định 1 worker để
+# mọi request của một session vào cùng chỗ. Tăng GUNICORN_WORKERS khi đã có
+# storage dùng chung.
+workers = int(os.getenv('GUNICORN_WORKERS', '1'))
+threads = int(os.getenv('GUNICORN_THREADS', '16'))
+
+# OpenAI Whisper + Chat + TTS có thể mất hơn 30s
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '120'))
+# Cho request đang chờ OpenAI chạy xong khi restart add-on
+graceful_timeout = timeout
+keepalive = 75
+
+# Heartbeat file của worker trên tmpfs (overlay FS trong container ghi chậm)
+if os.path.isdir('/dev/shm'):
+    worker_tmp_dir = '/dev/shm'
+
+accesslog = None
+errorlog = '-'
+loglevel = os.getenv('LOG_LEVEL', 'INFO').lower()
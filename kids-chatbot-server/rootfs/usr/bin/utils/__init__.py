@@ -1,6 +1,6 @@
 """Utility functions for the chatbot"""
 
-from .content_filter import is_safe_content
+from .content_filter import is_safe_content, detect_language, classify
 from .response_templates import get_response_template
 
-__all__ = ['is_safe_content', 'get_response_template']
+__all__ = ['is_safe_content', 'detect_language', 'classify', 'get_response_template']
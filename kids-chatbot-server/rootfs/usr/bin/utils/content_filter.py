@@ -1,29 +1,143 @@
 """Content filtering utilities"""
 
+import re
+from collections import Counter
+from functools import lru_cache, wraps
+
+# List of inappropriate keywords (expand as needed)
+INAPPROPRIATE_KEYWORDS = [
+    # English
+    'violence', 'weapon', 'drug', 'alcohol', 'kill', 'death', 'blood',
+    'sex', 'porn', 'nude', 'hate', 'racist', 'bomb', 'terrorist',
+    
+    # Vietnamese
+    'bạo lực', 'vũ khí', 'ma túy', 'rượu', 'giết', 'chết', 'máu',
+    'sex', 'khiêu dâm', 'khỏa thân', 'ghét', 'phân biệt', 'bom', 'khủng bố',
+]
+
+VIETNAMESE_CHARS = 'àáảãạăằắẳẵặâầấẩẫậèéẻẽẹêềếểễệìíỉĩịòóỏõọôồốổỗộơờớởỡợùúủũụưừứửữựỳýỷỹỵđ'
+
+# frozenset: kiểm tra thành viên O(1) thay vì quét chuỗi VIETNAMESE_CHARS
+_VIETNAMESE_CHAR_SET = frozenset(VIETNAMESE_CHARS)
+
+# Hợp các từ khoá cấm thành một regex: quét text một lần ở C thay vì lặp từng từ khoá
+_INAPPROPRIATE_PATTERN = '|'.join(map(re.escape, INAPPROPRIATE_KEYWORDS))
+_INAPPROPRIATE_RE = re.compile(_INAPPROPRIATE_PATTERN)
+
+# Một regex duy nhất: từ khoá cấm | ký tự tiếng Việt | chữ ASCII | chữ cái khác
+_CLASSIFY_RE = re.compile(
+    '(?P<bad>' + _INAPPROPRIATE_PATTERN + ')'
+    '|(?P<vi>[' + VIETNAMESE_CHARS + '])'
+    '|(?P<en>[a-z])'
+    r'|(?P<alpha>[^\W\d_])'
+)
+
+# Câu nói của trẻ lặp lại rất nhiều ("hello", "mở nhạc"...): nhớ kết quả quét theo text
+# Danh sách từ khoá cố định lúc import nên không cần khoá phiên bản
+CLASSIFY_CACHE_SIZE = 4096
+# Chỉ cache câu ngắn: cache giữ tối đa CLASSIFY_CACHE_SIZE * CLASSIFY_CACHE_MAX_CHARS ký tự
+CLASSIFY_CACHE_MAX_CHARS = 256
+
+
+def _cache_short_text(func):
+    """lru_cache cho text ngắn; text dài gọi thẳng func, không bị giữ lại trong bộ nhớ"""
+    cached = lru_cache(maxsize=CLASSIFY_CACHE_SIZE)(func)
+    
+    @wraps(func)
+    def wrapper(text):
+        if len(text) <= CLASSIFY_CACHE_MAX_CHARS:
+            return cached(text)
+        return func(text)
+    
+    wrapper.cache_info = cached.cache_info
+    wrapper.cache_clear = cached.cache_clear
+    return wrapper
+
+
+@_cache_short_text
 def is_safe_content(text):
     """
     Basic content filter for inappropriate content
     Returns True if content is safe, False otherwise
     """
+    return _INAPPROPRIATE_RE.search(text.lower()) is None
+
+
+def _language_from_counts(vi_char_count, en_char_count, total_alpha):
+    """Quyết định ngôn ngữ dựa trên tỷ lệ ký tự"""
+    if total_alpha == 0:
+        return 'auto'
     
-    # List of inappropriate keywords (expand as needed)
-    inappropriate_keywords = [
-        # English
-        'violence', 'weapon', 'drug', 'alcohol', 'kill', 'death', 'blood',
-        'sex', 'porn', 'nude', 'hate', 'racist', 'bomb', 'terrorist',
-        
-        # Vietnamese
-        'bạo lực', 'vũ khí', 'ma túy', 'rượu', 'giết', 'chết', 'máu',
-        'sex', 'khiêu dâm', 'khỏa thân', 'ghét', 'phân biệt', 'bom', 'khủng bố',
-    ]
+    # Tính tỷ lệ
+    vi_ratio = vi_char_count / total_alpha
+    en_ratio = en_char_count / total_alpha
     
+    # Quyết định dựa trên tỷ lệ
+    if vi_ratio > 0.1:  # Nếu >10% là ký tự tiếng Việt → tiếng Việt
+        return 'vi'
+    elif en_ratio > 0.5:  # Nếu >50% là ký tự ASCII → tiếng Anh
+        return 'en'
+    else:
+        return 'auto'
+
+
+def detect_language(text):
+    """
+    Nhận diện ngôn ngữ dựa trên bộ ký tự
+    Improved version: Kiểm tra tỷ lệ thay vì chỉ có/không có
+    """
     text_lower = text.lower()
     
-    for keyword in inappropriate_keywords:
-        if keyword in text_lower:
-            return False
+    # Text toàn ASCII: mọi chữ cái đều là chữ tiếng Anh
+    if text_lower.isascii():
+        alpha_count = sum(map(str.isalpha, text_lower))
+        return _language_from_counts(0, alpha_count, alpha_count)
+    
+    # Đếm số lượng ký tự mỗi loại: Counter đếm ở C, sau đó chỉ duyệt các ký tự khác nhau
+    vi_char_count = en_char_count = total_alpha = 0
+    for char, count in Counter(text_lower).items():
+        if char.isalpha():
+            total_alpha += count
+            if char in _VIETNAMESE_CHAR_SET:
+                vi_char_count += count
+            elif char.isascii():
+                en_char_count += count
+    
+    return _language_from_counts(vi_char_count, en_char_count, total_alpha)
+
+
+@_cache_short_text
+def classify(text):
+    """
+    Nhận diện ngôn ngữ và kiểm tra nội dung trong một lần quét
+    Returns: (language, is_safe)
+    """
+    vi_char_count = en_char_count = total_alpha = 0
+    safe = True
+    
+    for match in _CLASSIFY_RE.finditer(text.lower()):
+        kind = match.lastgroup
+        if kind == 'bad':
+            safe = False
+            # Vẫn đếm ký tự trong từ khoá để tỷ lệ ngôn ngữ không bị lệch
+            for char in match.group():
+                if char.isalpha():
+                    total_alpha += 1
+                    if char in _VIETNAMESE_CHAR_SET:
+                        vi_char_count += 1
+                    elif char.isascii():
+                        en_char_count += 1
+        else:
+            # [^\W\d_] còn khớp cả số không thập phân (², ½, Ⅻ) mà isalpha() loại → bỏ qua như detect_language
+            if kind == 'alpha' and not match.group().isalpha():
+                continue
+            total_alpha += 1
+            if kind == 'vi':
+                vi_char_count += 1
+            elif kind == 'en':
+                en_char_count += 1
     
-    return True
+    return _language_from_counts(vi_char_count, en_char_count, total_alpha), safe
 
 
 def sanitize_text(text):
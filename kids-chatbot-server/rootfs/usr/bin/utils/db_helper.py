@@ -127,7 +127,7 @@ class DatabaseHelper:
                 session_data.get('metadata', {}).get('title', f"Conversation {session_id[:8]}"),
                 session_data['created_at'],
                 session_data['last_activity'],
-                len(session_data['messages']) - 1,  # -1 để không đếm system message
+                session_data.get('message_count', len(session_data['messages'])),
                 json.dumps(session_data.get('metadata', {}))
             ))
             
@@ -176,6 +176,43 @@ class DatabaseHelper:
             cursor.close()
             conn.close()
     
+    @classmethod
+    def replace_messages(cls, session_id, messages):
+        """Ghi đè lịch sử hội thoại (sau khi tóm tắt), giữ lại system prompt"""
+        conn = cls._pool.get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute("""
+                DELETE FROM chatbot_messages 
+                WHERE session_id = %s AND role != 'system'
+            """, (session_id,))
+            
+            now = datetime.now()
+            rows = [
+                (session_id, msg['role'], msg['content'], now, 0)
+                for msg in messages if msg['role'] != 'system'
+            ]
+            if rows:
+                cursor.executemany("""
+                    INSERT INTO chatbot_messages 
+                    (session_id, role, content, timestamp, tokens_used)
+                    VALUES (%s, %s, %s, %s, %s)
+                """, rows)
+            
+            conn.commit()
+            logger.debug(f"💬 Replaced {len(rows)} messages of session {session_id} in database")
+            return True
+            
+        except Exception as e:
+            logger.error(f"❌ Failed to replace messages of session {session_id}: {e}")
+            conn.rollback()
+            return False
+        
+        finally:
+            cursor.close()
+            conn.close()
+    
     @classmethod
     def load_session(cls, session_id):
         """Load session từ database"""
@@ -199,7 +236,7 @@ class DatabaseHelper:
                 SELECT role, content, timestamp 
                 FROM chatbot_messages 
                 WHERE session_id = %s 
-                ORDER BY timestamp ASC
+                ORDER BY timestamp ASC, id ASC
             """, (session_id,))
             
             messages = [
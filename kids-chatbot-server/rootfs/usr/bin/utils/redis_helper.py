@@ -0,0 +1,155 @@
+# rootfs/usr/bin/utils/redis_helper.py
+
+import redis
+import json
+import logging
+from datetime import datetime
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+
+def _dumps(obj):
+    """JSON (UTF-8, không escape) cho giá trị lưu trong Redis; orjson nếu có"""
+    if orjson:
+        return orjson.dumps(obj).decode('utf-8')
+    return json.dumps(obj, ensure_ascii=False)
+
+
+_loads = orjson.loads if orjson else json.loads
+
+
+class RedisSessionStore:
+    """Lưu session/lịch sử chat trên Redis, hết hạn tự động bằng TTL"""
+    
+    _client = None
+    _ttl_seconds = 1800
+    _max_messages = 20
+    
+    @classmethod
+    def initialize(cls, redis_url, ttl_seconds, max_messages):
+        """Khởi tạo connection pool tới Redis"""
+        try:
+            cls._client = redis.Redis.from_url(redis_url, decode_responses=True)
+            cls._client.ping()
+            cls._ttl_seconds = ttl_seconds
+            cls._max_messages = max_messages
+            logger.info("✅ Redis connection pool initialized")
+        except Exception as e:
+            logger.error(f"❌ Failed to initialize Redis: {e}")
+            raise
+    
+    @staticmethod
+    def _meta_key(session_id):
+        return f"session:{session_id}:meta"
+    
+    @staticmethod
+    def _messages_key(session_id):
+        return f"session:{session_id}:messages"
+    
+    @classmethod
+    def save_session(cls, session_id, session_data):
+        """Lưu thông tin session (hash) và làm mới TTL"""
+        try:
+            meta_key = cls._meta_key(session_id)
+            pipe = cls._client.pipeline()
+            pipe.hset(meta_key, mapping={
+                'language': session_data.get('language', 'vi'),
+                'voice': session_data.get('voice', 'alloy'),
+                'voice_override': int(session_data.get('voice_override', False)),
+                'created_at': session_data['created_at'].isoformat(),
+                'last_activity': session_data['last_activity'].isoformat(),
+                'message_count': session_data.get('message_count', len(session_data['messages'])),
+                'metadata': _dumps(session_data.get('metadata', {}))
+            })
+            pipe.expire(meta_key, cls._ttl_seconds)
+            pipe.expire(cls._messages_key(session_id), cls._ttl_seconds)
+            pipe.execute()
+            return True
+        
+        except Exception as e:
+            logger.error(f"❌ Failed to save session {session_id} to Redis: {e}")
+            return False
+    
+    @classmethod
+    def save_message(cls, session_id, role, content, tokens_used=0):
+        """Thêm tin nhắn: RPUSH + LTRIM + EXPIRE trong một round-trip"""
+        if role == 'system':
+            return True  # System prompt tạo lại từ language khi load
+        
+        try:
+            messages_key = cls._messages_key(session_id)
+            pipe = cls._client.pipeline()
+            pipe.rpush(messages_key, _dumps({'role': role, 'content': content}))
+            pipe.ltrim(messages_key, -cls._max_messages, -1)
+            pipe.expire(messages_key, cls._ttl_seconds)
+            pipe.expire(cls._meta_key(session_id), cls._ttl_seconds)
+            pipe.execute()
+            return True
+        
+        except Exception as e:
+            logger.error(f"❌ Failed to save message to Redis: {e}")
+            return False
+    
+    @classmethod
+    def replace_messages(cls, session_id, messages):
+        """Ghi đè toàn bộ lịch sử (sau khi tóm tắt) trong một transaction"""
+        try:
+            messages_key = cls._messages_key(session_id)
+            pipe = cls._client.pipeline()
+            pipe.delete(messages_key)
+            history = [_dumps(msg) for msg in messages if msg['role'] != 'system']
+            if history:
+                pipe.rpush(messages_key, *history[-cls._max_messages:])
+                pipe.expire(messages_key, cls._ttl_seconds)
+            pipe.execute()
+            return True
+        
+        except Exception as e:
+            logger.error(f"❌ Failed to replace messages of session {session_id} in Redis: {e}")
+            return False
+    
+    @classmethod
+    def load_session(cls, session_id):
+        """Load session từ Redis (cùng format với DatabaseHelper.load_session)"""
+        try:
+            pipe = cls._client.pipeline()
+            pipe.hgetall(cls._meta_key(session_id))
+            pipe.lrange(cls._messages_key(session_id), 0, -1)
+            meta, raw_messages = pipe.execute()
+            
+            if not meta:
+                return None
+            
+            session_data = {
+                'messages': [_loads(msg) for msg in raw_messages],
+                'language': meta.get('language', 'vi'),
+                'voice': meta.get('voice', 'alloy'),
+                'voice_override': meta.get('voice_override') == '1',
+                'created_at': datetime.fromisoformat(meta['created_at']),
+                'last_activity': datetime.fromisoformat(meta['last_activity']),
+                'metadata': _loads(meta['metadata']) if meta.get('metadata') else {}
+            }
+            
+            logger.info(f"📂 Loaded session {session_id} from Redis ({len(raw_messages)} messages)")
+            return session_data
+        
+        except Exception as e:
+            logger.error(f"❌ Failed to load session {session_id} from Redis: {e}")
+            return None
+    
+    @classmethod
+    def delete_session(cls, session_id):
+        """Xóa session"""
+        try:
+            cls._client.delete(cls._meta_key(session_id), cls._messages_key(session_id))
+            logger.info(f"🗑️ Deleted session {session_id} from Redis")
+            return True
+        
+        except Exception as e:
+            logger.error(f"❌ Failed to delete session {session_id} from Redis: {e}")
+            return False
@@ -1,9 +1,14 @@
 # rootfs/usr/bin/utils/response_templates.py
 
+from functools import lru_cache
+
+
+@lru_cache(maxsize=32)
 def get_response_template(template_type, language='auto'):
     """
     Returns a system prompt or response template with educational and ethical standards.
     Now supports dynamic language switching.
+    Kết quả (str) được cache theo (template_type, language): dict prompts chỉ dựng một lần mỗi cặp.
     """
     prompts = {
         'system': {